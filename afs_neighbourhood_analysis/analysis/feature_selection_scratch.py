@@ -16,12 +16,13 @@ from toolz import pipe
 from afs_neighbourhood_analysis.getters.early_years_scores_eyfsp import (
     get_edu_dataframes,
 )
+from afs_neighbourhood_analysis.pipeline.fingertips.utils import (
+    read_public_health_profile,
+)
 from fingertips_py import (
     get_metadata_for_profile_as_dataframe,
 )
 
-from afs_neighbourhood_analysis import PROJECT_DIR
-
 EY_VARS_KEEP = [
     "time_period",
     "geographic_level",
@@ -87,13 +88,15 @@ def el_goals() -> pd.DataFrame:
     return pipe(get_edu_dataframes()["ELG_GLD"], parse_ey_table)
 
 
-def public_health_framework():
-    """Read public health framework indicators"""
+def public_health_framework(columns: list = None):
+    """Read public health framework indicators
 
-    return (
-        pd.read_csv(f"{PROJECT_DIR}/inputs/data/public_health_profile.csv")
-        .query("area_type=='Counties & UAs (from Apr 2021)'")
-        .reset_index(drop=True)
+    Args:
+        columns: only read these columns
+    """
+
+    return read_public_health_profile(
+        area_type="Counties & UAs (from Apr 2021)", columns=columns
     )
 
 
@@ -1,11 +1,13 @@
 import os
+import re
+from typing import Callable, Iterable, Iterator, Union
 
+import numpy as np
 import pandas as pd
 from toolz import pipe
 
 from afs_neighbourhood_analysis import PROJECT_DIR
 
-
 profile_path = f"{PROJECT_DIR}/outputs/reports/data_profiles"
 
 os.makedirs(profile_path, exist_ok=True)
@@ -52,45 +54,216 @@ def last_year(period: str):
         return int(period)
 
 
+# Regular expressions for the period formats handled by last_year, in the
+# same order as its branches. Each one captures the last year (or its last
+# two digits) and is paired with the prefix that turns it into a year
+PERIOD_PATTERNS = [
+    # 2019/20, 2016/17 - 18/19
+    (r"^(?!.*Q).*/(\d{2})$", "20"),
+    # 2019/20 Q1 - 2020/21 Q2
+    (r"^(?=.*Q)[^-]*-\s*[^\s/-]*/(\d{2})(?:[ -]|$)", "20"),
+    # Mar 2019 - Feb 2020
+    (r"^(?!.*/)(?=.*-)(?=.*(?:Mar|Jul|Aug)).* (\d{4})$", ""),
+    # 2016 - 18
+    (r"^(?!.*[/Q])(?!.*(?:Mar|Jul|Aug))[^-]*-\s*(\d{2})\s*$", "20"),
+    # 2019/20 Q1
+    (r"^(?!.*-)(?=.*Q)[^ /]*/(\d{2}) ", "20"),
+    # 2019 Q1
+    (r"^(?!.*[-/])(?=.*Q)(\d{4}) ", ""),
+    # Calendar 2019
+    (r"^(?!.*[-/Q])[^ ]* (\d{4})(?: |$)", ""),
+    # 2019
+    (r"^(\d{4})$", ""),
+]
+
+
+def last_years(periods: pd.Series) -> pd.Series:
+    """Vectorised version of last_year for a series of time periods
+
+    Periods are parsed once per distinct value with the regular expressions
+    in PERIOD_PATTERNS. Values that don't match any of them are parsed with
+    last_year. Periods without a year (e.g. quarters of a range of years)
+    and missing periods are NaN.
+    """
+
+    codes, uniques = pd.factorize(periods)
+    unique_periods = pd.Series(uniques, dtype=object)
+
+    years = pd.Series(np.nan, index=unique_periods.index)
+    is_str = unique_periods.map(lambda period: isinstance(period, str))
+    is_int = unique_periods.map(lambda period: type(period) == int)
+    years[is_int] = unique_periods[is_int].astype(float)
+
+    strings = unique_periods[is_str]
+    for pattern, prefix in PERIOD_PATTERNS:
+        pending = strings[years[strings.index].isna()]
+        matches = pending.str.extract(pattern, expand=False).dropna()
+        years[matches.index] = (prefix + matches).astype(float)
+
+    fallback = unique_periods[years.isna() & ~is_int]
+    years[fallback.index] = fallback.map(last_year).astype(float)
+
+    values = np.append(years.to_numpy(dtype=float), np.nan)[codes]
+
+    return pd.Series(
+        values if np.isnan(values).any() else values.astype(int),
+        index=periods.index,
+    )
+
+
+PUBLIC_HEALTH_COLS = [
+    "indicator_id",
+    "indicator_name",
+    "area_code",
+    "area_name",
+    "area_type",
+    "sex",
+    "age",
+    "category_type",
+    "category",
+    "last_year",
+    "time_period",
+    "value",
+]
+
+
 def parse_public_health(public_health_indicators: pd.DataFrame) -> pd.DataFrame:
     """Parsing of public health indicators"""
 
-    keep_cols = [
-        "indicator_id",
-        "indicator_name",
-        "area_code",
-        "area_name",
-        "area_type",
-        "sex",
-        "age",
-        "category_type",
-        "category",
-        "last_year",
-        "time_period",
-        "value",
-    ]
-
     return public_health_indicators.assign(
-        last_year=lambda df: df["time_period"].apply(last_year)
-    )[keep_cols]
+        last_year=lambda df: last_years(df["time_period"])
+    )[PUBLIC_HEALTH_COLS]
+
+
+# Substrings of the fingertips area types in each geography level
+AREA_LEVELS = {"districts": "Districts", "counties": "Counties"}
+
+
+def area_level_masks(area_types: pd.Series, levels: Iterable[str]) -> dict:
+    """Rows of an area type column in each geography level
+
+    Area types are matched once per distinct value (categories if the
+    column is categorical) rather than once per row.
+
+    Args:
+        area_types: area type column of a fingertips table
+        levels: keys of AREA_LEVELS
+
+    Returns:
+        A lookup between levels and boolean masks
+    """
+
+    codes, uniques = pd.factorize(area_types)
+
+    return {
+        level: np.isin(
+            codes,
+            [code for code, x in enumerate(uniques) if AREA_LEVELS[level] in x],
+        )
+        for level in levels
+    }
+
+
+def split_area_levels(
+    public_health_indicators: pd.DataFrame, levels: Iterable[str] = AREA_LEVELS
+) -> dict:
+    """Splits public health indicators by geography level in a single pass
+
+    Args:
+        public_health_indicators: table with an area_type column
+        levels: keys of AREA_LEVELS
+
+    Returns:
+        A lookup between levels and the rows for that level
+    """
+
+    return {
+        level: public_health_indicators.loc[mask].reset_index(drop=True)
+        for level, mask in area_level_masks(
+            public_health_indicators["area_type"], levels
+        ).items()
+    }
 
 
 def keep_districts(public_health_indicators: pd.DataFrame) -> pd.DataFrame:
     """Keeps districts / unitary authorities"""
 
-    return public_health_indicators.loc[
-        public_health_indicators["area_type"].apply(lambda x: "Districts" in x)
-    ].reset_index(drop=True)
+    return split_area_levels(public_health_indicators, ["districts"])["districts"]
 
 
 def keep_counties(public_health_indicators: pd.DataFrame) -> pd.DataFrame:
-    """Keeps districts / unitary authorities"""
+    """Keeps counties / unitary authorities"""
 
-    return public_health_indicators.loc[
-        public_health_indicators["area_type"].apply(lambda x: "Counties" in x)
-    ].reset_index(drop=True)
+    return split_area_levels(public_health_indicators, ["counties"])["counties"]
 
 
 def parse_health_indicators(health_indicators: pd.DataFrame) -> pd.DataFrame:
     """Applies the pipeline above to health indicators"""
     return pipe(health_indicators, parse_public_health, keep_counties)
+
+
+def read_health_indicator(
+    table: Union[pd.DataFrame, str], chunksize: int = None
+) -> Iterator[pd.DataFrame]:
+    """Yields the columns of a fingertips table needed by parse_public_health
+
+    Args:
+        table: fingertips table or path to a fingertips csv
+        chunksize: number of rows read at a time from a csv. By default we
+            read the whole file
+
+    Yields:
+        The table (or chunks of the csv) with clean column names
+    """
+
+    def clean_column(col: str) -> str:
+        return re.sub(" ", "_", col).lower()
+
+    cols = [col for col in PUBLIC_HEALTH_COLS if col != "last_year"]
+
+    if isinstance(table, pd.DataFrame):
+        yield table.rename(columns=clean_column)[cols]
+        return
+
+    chunks = pd.read_csv(
+        table,
+        usecols=lambda col: clean_column(col) in cols,
+        chunksize=chunksize,
+        low_memory=False,
+    )
+
+    for chunk in [chunks] if chunksize is None else chunks:
+        yield chunk.rename(columns=clean_column)[cols]
+
+
+def stream_health_indicators(
+    tables: Iterable[Union[pd.DataFrame, str]],
+    area_filter: Callable = keep_counties,
+    chunksize: int = None,
+) -> pd.DataFrame:
+    """Parses fingertips tables filtering each of them before concatenating
+
+    This gives the same result as concatenating the tables and applying
+    parse_health_indicators, but we only hold the rows and columns we keep
+    from all the tables at once
+
+    Args:
+        tables: fingertips tables or paths to fingertips csvs. None values
+            (indicators we failed to fetch) are skipped
+        area_filter: function that keeps the area types we want
+        chunksize: number of rows read at a time from csvs
+
+    Returns:
+        The parsed table
+    """
+
+    return pipe(
+        (
+            area_filter(chunk)
+            for table in tables
+            if table is not None
+            for chunk in read_health_indicator(table, chunksize)
+        ),
+        lambda chunks: pd.concat(chunks, ignore_index=True),
+        parse_public_health,
+    )
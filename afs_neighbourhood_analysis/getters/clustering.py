@@ -1,5 +1,6 @@
 # Getters for clustering outputs etc
 
+import os
 import pickle
 from functools import partial
 
@@ -16,6 +17,7 @@ from afs_neighbourhood_analysis.analysis.feature_selection_scratch import (
 from afs_neighbourhood_analysis.pipeline.lad_clustering.cluster_utils import (
     clustering_consequential_pipe,
     parse_phf,
+    read_grid_search_results,
 )
 
 from afs_neighbourhood_analysis.pipeline.lad_clustering.conseq_clustering import (
@@ -55,16 +57,32 @@ def clustering_diagnostics() -> pd.DataFrame:
             communication, language and literature and early year goals,
             and % with good level of development.
         value: score for the diagnostic variable
-    """
 
-    with open(
-        f"{PROJECT_DIR}/inputs/data/cluster_grid_search_results.p", "rb"
-    ) as infile:
-        results = pickle.load(infile)
+    The grid search saves its results as they complete so this also reads
+    the results of a grid search that is still running or was interrupted.
+    If a configuration was run more than once (e.g. with another community
+    backend) we keep its latest result.
+    """
 
-    return pd.DataFrame([parse_clustering_diagnostics(r) for r in results]).melt(
-        id_vars=["pca", "comm_resolution", "num_clusters"],
-        var_name="diagnostic_var",
+    results_path = f"{PROJECT_DIR}/inputs/data/cluster_grid_search_results.jsonl"
+
+    if os.path.exists(results_path):
+        results = read_grid_search_results(results_path)
+
+    else:
+        # Results saved by older versions of the grid search
+        with open(
+            f"{PROJECT_DIR}/inputs/data/cluster_grid_search_results.p", "rb"
+        ) as infile:
+            results = pickle.load(infile)
+
+    return (
+        pd.DataFrame([parse_clustering_diagnostics(r) for r in results])
+        .drop_duplicates(subset=["pca", "comm_resolution"], keep="last")
+        .melt(
+            id_vars=["pca", "comm_resolution", "num_clusters"],
+            var_name="diagnostic_var",
+        )
     )
 
 
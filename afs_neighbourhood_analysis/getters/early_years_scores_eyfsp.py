@@ -1,14 +1,79 @@
+import logging
+import os
+
 import pandas as pd
-import numpy as np
+import pyarrow as pa
+from pyarrow import feather
 from afs_neighbourhood_analysis import PROJECT_DIR
 
 input_fpath = f"{PROJECT_DIR}/outputs"
 
+# Typed copies of the source files, saved as uncompressed feather so that they can be memory mapped
+cache_fpath = f"{PROJECT_DIR}/inputs/data/eyfsp_cache"
+
+EDU_SOURCES = {
+    "ELG_GLD": "APS_GLD_ELG_EXP_2013_2019.csv",
+    "AoL": "AREAS_OF_LEARNING_2013_2019.csv",
+    "ELG": "ELG_2013_2019.csv",
+    "ELG_GLD_add": "EYFSP_LA_1_key_measures_additional_tables_2013_2019.xlsx",
+    "COM_LIT_MAT": "EYFSP_LA_2_com_lit_maths_additional_tables_2013_2019.xlsx",
+    "ELG_GLD_LAD": "EYFSP_LAD_pr_additional_tables_2014_2019.xlsx",
+}
+
+# Values used for suppressed or missing figures
+SUPPRESSION_MARKERS = ["."]
+
+
+def read_edu_source(file: str) -> pd.DataFrame:
+    """
+    Reads a source csv or excel file, parsing suppression markers as NaN so that numeric columns get numeric dtypes.
+    """
+
+    if ".csv" in file:
+        return pd.read_csv(file, na_values=SUPPRESSION_MARKERS)
+    return pd.read_excel(file, engine="openpyxl", na_values=SUPPRESSION_MARKERS)
+
+
+def convert_edu_sources(source_fpath: str = input_fpath, cache_path: str = cache_fpath):
+    """
+    Converts the source files into feather files in cache_path. Files are only converted if they are missing or older than their source.
+
+    Returns:
+        List with the keys of the sources that we couldn't convert (e.g. because they have columns with mixed types). They are read from the source.
+    """
+
+    os.makedirs(cache_path, exist_ok=True)
+
+    failed = []
+
+    for key, filename in EDU_SOURCES.items():
+        source = f"{source_fpath}/{filename}"
+        cached = f"{cache_path}/{key}.feather"
+
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(
+            source
+        ):
+            continue
 
-def get_edu_dataframes():
+        logging.info(f"Converting {filename}")
+        try:
+            read_edu_source(source).to_feather(cached, compression="uncompressed")
+        except (ValueError, pa.ArrowException) as error:
+            logging.info(f"Can't convert {filename}: {error}")
+            if os.path.exists(cached):
+                os.remove(cached)
+            failed.append(key)
+
+    return failed
+
+
+def get_edu_dataframes(cache: bool = True):
     """
     TEMPORARY getter for retrieving the csv files from afs_neighbourhood_analysis/outputs and converting them into cleaned pd.DataFrames. Stored in a dictionary of dataframes.
 
+    Args:
+        cache: read the typed, memory mapped copies of the files (converting them the first time around) instead of the source files
+
     Outputs:
         Dictionary of pd.DataFrames with the following keys -
         ELG_GLD = DataFrame containing the numbers and percentages of Early Learning Goals and Good Levels of Development for national, regional and unitary authority, separated by gender. Spans the years 2013-2019.
@@ -20,25 +85,18 @@ def get_edu_dataframes():
 
     """
 
-    keys = ["ELG_GLD", "AoL", "ELG", "ELG_GLD_add", "COM_LIT_MAT", "ELG_GLD_LAD"]
-
-    filenames = [
-        f"{input_fpath}/APS_GLD_ELG_EXP_2013_2019.csv",
-        f"{input_fpath}/AREAS_OF_LEARNING_2013_2019.csv",
-        f"{input_fpath}/ELG_2013_2019.csv",
-        f"{input_fpath}/EYFSP_LA_1_key_measures_additional_tables_2013_2019.xlsx",
-        f"{input_fpath}/EYFSP_LA_2_com_lit_maths_additional_tables_2013_2019.xlsx",
-        f"{input_fpath}/EYFSP_LAD_pr_additional_tables_2014_2019.xlsx",
-    ]
+    uncached = (
+        convert_edu_sources(input_fpath, cache_fpath) if cache else list(EDU_SOURCES)
+    )
 
     edu_dataframes = {}
 
-    for key, file in zip(keys, filenames):
-        if ".csv" in file:
-            df = pd.read_csv(file)
+    for key, filename in EDU_SOURCES.items():
+        if key in uncached:
+            edu_dataframes[key] = read_edu_source(f"{input_fpath}/{filename}")
         else:
-            df = pd.read_excel(file, engine="openpyxl")
-        df.replace(".", np.nan, inplace=True)
-        edu_dataframes[key] = df
+            edu_dataframes[key] = feather.read_table(
+                f"{cache_fpath}/{key}.feather", memory_map=True
+            ).to_pandas()
 
     return edu_dataframes
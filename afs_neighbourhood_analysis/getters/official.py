@@ -1,22 +1,34 @@
-import json
+import hashlib
 import logging
-import os
+from functools import partial
 
 import pandas as pd
+import requests
+from metaflow.exception import MetaflowException, MetaflowNotFound
 from toolz import pipe
-from fingertips_py import (
-    get_all_profiles,
-    get_metadata_for_profile_as_dataframe,
-    get_all_areas_for_all_indicators,
-)
 
 from afs_neighbourhood_analysis import PROJECT_DIR
-from afs_neighbourhood_analysis.pipeline.fingertips.utils import clean_fingertips_table
+from afs_neighbourhood_analysis.pipeline.fingertips.utils import (
+    FINGERTIPS_API,
+    clean_fingertips_table,
+    fetch_available_data,
+    fetch_profile_metadata,
+    fetch_profiles,
+    fingertips_cache,
+)
+from afs_neighbourhood_analysis.utils.http_cache import ResponseCache
+from afs_neighbourhood_analysis.utils.lookups import LookupStore, memoise_for
 from afs_neighbourhood_analysis.utils.metaflow import get_run
 
 
 DISTRICT_IDS = set([101, 301, 401])
 
+# Lookups are rebuilt when the data they come from changes
+lookup_store = LookupStore(f"{PROJECT_DIR}/inputs/data/lookups")
+
+# Seconds we reuse a data version before checking it again
+VERSION_TTL = 60
+
 
 def fetch_indicator_table(profile_id: int) -> pd.DataFrame:
     """Fetch indicators based on their profile.
@@ -28,53 +40,97 @@ def fetch_indicator_table(profile_id: int) -> pd.DataFrame:
     return get_run("ParseIndicators").data.framework_clean_dfs[profile_id]
 
 
+@memoise_for(VERSION_TTL)
+def parsed_indicators_version() -> str:
+    """Data version of lookups built from the ParseIndicators flow (None if
+    the flow hasn't run or we can't reach the metadata service)
+    """
+
+    try:
+        return get_run("ParseIndicators").pathspec
+    except (MetaflowException, requests.exceptions.ConnectionError) as exc:
+        logging.info(f"No ParseIndicators run available: {exc}")
+        return None
+
+
+@memoise_for(VERSION_TTL)
+def fingertips_version() -> str:
+    """Data version of lookups built from the fingertips API: a hash of the
+    profiles and of the areas where each indicator is available. We combine
+    the content hashes of the cached responses, so unchanged responses
+    aren't read again
+    """
+
+    cache = fingertips_cache()
+
+    return hashlib.sha256(
+        "".join(
+            cache.content_hash(f"{FINGERTIPS_API}{endpoint}")
+            for endpoint in ["profiles", "available_data"]
+        ).encode()
+    ).hexdigest()
+
+
+def build_area_name_lookup() -> dict:
+    """Lookup between area codes and names from the parsed indicators"""
+
+    return (
+        fetch_indicator_table(19)
+        .drop_duplicates(subset=["area_code"])
+        .set_index("area_code")["area_name"]
+        .to_dict()
+    )
+
+
 def area_name_lookup() -> dict:
     """Lookup between area names and codes"""
 
-    lookup_dir = f"{PROJECT_DIR}/inputs/data/la_name_lookup.json"
-
-    # It checks if it needs to make the lookup first time around
-    if os.path.exists(lookup_dir) is False:
-        logging.info("making lookup")
+    # Without a run we can only use the lookup we made last time
+    version = parsed_indicators_version() or lookup_store.stored_version("area_names")
 
-        lookup = (
-            fetch_indicator_table(19)
-            .drop_duplicates(subset=["area_code"])
-            .set_index("area_code")["area_name"]
-            .to_dict()
+    if version is None:
+        raise MetaflowNotFound(
+            "No ParseIndicators run to build the area name lookup from"
         )
 
-        with open(lookup_dir, "w") as outfile:
-            json.dump(lookup, outfile)
+    return lookup_store.get("area_names", version, build_area_name_lookup)
 
-        return lookup
 
-    else:
+def build_profile_name_lookup(cache: ResponseCache = None) -> dict:
+    """Lookup between frameworks and names from the fingertips API"""
 
-        with open(lookup_dir, "r") as infile:
-            return json.load(infile)
+    return {
+        profile_dict["Id"]: profile_dict["Name"]
+        for profile_dict in fetch_profiles(cache=cache or fingertips_cache())
+    }
 
 
 def profile_name_lookup() -> dict:
     """Lookup between frameworks and names"""
 
-    return {
-        profile_dict["Id"]: profile_dict["Name"] for profile_dict in get_all_profiles()
-    }
+    return lookup_store.get(
+        "profile_names",
+        fingertips_version(),
+        partial(build_profile_name_lookup, fingertips_cache()),
+    )
 
 
-def indicator_inventory() -> pd.DataFrame:
+def build_indicator_inventory(cache: ResponseCache = None) -> pd.DataFrame:
     """Table with metadata for all indicators
     available for each profile which are available at the local authority district level
 
     """
 
+    cache = cache or fingertips_cache()
+
+    profiles = fetch_profiles(cache=cache)
+
     # We use this to tag indicators with their profile
-    profile_name = profile_name_lookup()
+    profile_name = {profile["Id"]: profile["Name"] for profile in profiles}
 
     # This gets indicators which are availabel at the district level
     district_ind_ids = pipe(
-        get_all_areas_for_all_indicators(),
+        fetch_available_data(cache=cache),
         lambda df: df.loc[df["AreaTypeId"].isin(DISTRICT_IDS)]["IndicatorId"],
         set,
     )
@@ -83,11 +139,11 @@ def indicator_inventory() -> pd.DataFrame:
         pd.concat(
             [
                 (
-                    get_metadata_for_profile_as_dataframe(profile["Id"])
+                    fetch_profile_metadata(profile["Id"], cache=cache)
                     .assign(profile=profile["Id"])
                     .assign(profile_name=lambda df: df["profile"].map(profile_name))
                 )
-                for profile in get_all_profiles()
+                for profile in profiles
             ]
         ),
         lambda df: (
@@ -95,3 +151,16 @@ def indicator_inventory() -> pd.DataFrame:
         ),
         clean_fingertips_table,
     )
+
+
+def indicator_inventory() -> pd.DataFrame:
+    """Table with metadata for all indicators
+    available for each profile which are available at the local authority district level
+
+    """
+
+    return lookup_store.get(
+        "indicator_inventory",
+        fingertips_version(),
+        partial(build_indicator_inventory, fingertips_cache()),
+    )
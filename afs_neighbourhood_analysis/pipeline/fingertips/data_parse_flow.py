@@ -7,7 +7,8 @@ class ParseIndicators(FlowSpec):
     """Parses fingertips indicators
 
     Attributes:
-        framework_tables: lookup between framework and indicators
+        indicator_tables: lookup between indicator ids and tables
+        framework_indicators: lookup between framework and indicator ids
         framework_clean_dfs: lookup between framework and clean dfs
     """
 
@@ -18,15 +19,17 @@ class ParseIndicators(FlowSpec):
         """Starts the flow by reading the raw data"""
         from afs_neighbourhood_analysis.utils.metaflow import get_run
 
-        self.framework_tables = get_run("HealthIndicators").data.framework_tables
+        run = get_run("HealthIndicators")
+        self.indicator_tables = run.data.indicator_tables
+        self.framework_indicators = run.data.framework_indicators
 
         if self.test_mode is True and current.is_production is False:
             self.frameworks = [
-                f for f, t in self.framework_tables.items() if len(t) > 0
+                f for f, t in self.framework_indicators.items() if len(t) > 0
             ][:3]
         else:
             self.frameworks = [
-                f for f, t in self.framework_tables.items() if len(t) > 0
+                f for f, t in self.framework_indicators.items() if len(t) > 0
             ]
 
         self.next(self.parse_tables, foreach="frameworks")
@@ -34,15 +37,16 @@ class ParseIndicators(FlowSpec):
     @step
     def parse_tables(self):
         """For each framework, parse the data"""
-        from pandas import concat
-        from toolz import pipe
         from afs_neighbourhood_analysis.analysis.fingertips.load_eda import (
-            parse_health_indicators,
+            stream_health_indicators,
         )
 
+        # Each table is filtered before concatenation so we never hold the
+        # full tables of a framework at once
         self.frame_df_lookup = {
-            self.input: (
-                pipe(self.framework_tables[self.input], concat, parse_health_indicators)
+            self.input: stream_health_indicators(
+                self.indicator_tables[_id]
+                for _id in self.framework_indicators[self.input]
             )
         }
         self.next(self.join_tables)
@@ -4,47 +4,51 @@
 import logging
 
 import pandas as pd
-from fingertips_py import get_metadata_for_profile_as_dataframe
 from toolz import pipe
 
-from afs_neighbourhood_analysis import PROJECT_DIR
 from afs_neighbourhood_analysis.analysis.fingertips.load_eda import (
-    parse_health_indicators,
+    stream_health_indicators,
 )
 from afs_neighbourhood_analysis.pipeline.fingertips.utils import (
-    clean_fingertips_table,
-    robust_fetch_table,
+    fetch_profile_metadata,
+    fingertips_cache,
+    robust_fetch_tables,
+    save_public_health_profile,
 )
+from afs_neighbourhood_analysis.utils.http_cache import ResponseCache
 
 
-def fetch_profile(profile_id: int, verbose: bool = True) -> pd.DataFrame:
-    """Fetch all tables for an indicator"""
+def fetch_profile(
+    profile_id: int,
+    verbose: bool = True,
+    max_workers: int = 1,
+    cache: ResponseCache = None,
+) -> pd.DataFrame:
+    """Fetch all tables for an indicator
+
+    Args:
+        profile_id: profile to fetch
+        verbose: log progress
+        max_workers: number of indicators fetched concurrently over a shared
+            session
+        cache: optional cache for API responses (see fingertips_cache)
+    """
 
     indicator_ids = pipe(
-        set(get_metadata_for_profile_as_dataframe(profile_id)["Indicator ID"]), list
+        set(fetch_profile_metadata(profile_id, cache=cache)["Indicator ID"]), list
     )
 
-    indicator_table = []
-
-    for n, i in enumerate(indicator_ids):
-        if verbose:
-            if n % 10 == 0:
-                logging.info(i)
-
-        t = robust_fetch_table(i)
+    if verbose:
+        logging.info(f"Fetching {len(indicator_ids)} indicators")
 
-        if type(t) == pd.DataFrame:
-            table = pipe(t, clean_fingertips_table, parse_health_indicators)
-            indicator_table.append(table)
+    tables = robust_fetch_tables(indicator_ids, max_workers=max_workers, cache=cache)
 
-    return pd.concat(indicator_table).reset_index(drop=True)
+    return stream_health_indicators(tables[i] for i in indicator_ids)
 
 
 if __name__ == "__main__":
 
     pipe(
-        fetch_profile(19),
-        lambda df: df.to_csv(
-            f"{PROJECT_DIR}/inputs/data/public_health_profile.csv", index=False
-        ),
+        fetch_profile(19, max_workers=8, cache=fingertips_cache()),
+        save_public_health_profile,
     )
@@ -1,3 +1,4 @@
+import logging
 from typing import Dict, List
 
 from metaflow import current, FlowSpec, Parameter, project, step
@@ -13,38 +14,77 @@ class HealthIndicators(FlowSpec):
         test_mode: if we are running as a test
         framework_ids: ids for frameworks we want to collect
         indicator_ids: ids for indicators we want to collect
+        indicator_batches: indicator_ids split in chunks of batch_size. Each
+            foreach task fetches a chunk
         indicator_tables: dict with a key for each indicator
+        manifest: lookup between the indicators in indicator_tables and a
+            hash of their metadata when we fetched them
+        previous_run: pathspec of the run we update in incremental mode
+        indicator_frameworks: lookup between indicator ids and the frameworks
+            they belong to
+        framework_indicators: lookup between framework ids and the ids of
+            their indicators in indicator_tables
     """
 
     test_mode: bool
+    incremental: bool
     framework_ids: Dict
     indicator_ids: List
+    indicator_batches: List
     indicator_tables: Dict
-    framework_tables: Dict
+    manifest: Dict
+    previous_run: str
+    indicator_frameworks: Dict
+    framework_indicators: Dict
 
     test_mode = Parameter("test-mode", help="running in test mode", default=True)
+    incremental = Parameter(
+        "incremental",
+        help="only fetch indicators that changed since the last successful run",
+        default=False,
+    )
+    batch_size = Parameter(
+        "batch-size", help="number of indicators fetched by each task", default=50
+    )
+    max_workers = Parameter(
+        "max-workers",
+        help="number of concurrent requests in each task",
+        default=8,
+    )
 
     @step
     def start(self):
         """Start the flow by
         reading the indicator ids that we need to collect"""
 
-        from fingertips_py import get_all_profiles
+        from utils import fetch_profiles, fingertips_cache
 
-        self.framework_ids = [fr["Id"] for fr in get_all_profiles()]
+        # In incremental mode every cached response is revalidated with the
+        # API, otherwise a change in the last week could go unnoticed
+        cache = fingertips_cache(ttl=0) if self.incremental else fingertips_cache()
+
+        self.framework_ids = [fr["Id"] for fr in fetch_profiles(cache=cache)]
 
         self.next(self.fetch_indicator_ids)
 
     @step
     def fetch_indicator_ids(self):
         """Create list of ids and fetch tables for each framework"""
-        from fingertips_py import get_metadata_for_profile_as_dataframe
         from itertools import chain
+        from toolz import partition_all
+        from utils import (
+            changed_indicators,
+            fetch_profile_metadata,
+            fingertips_cache,
+            indicator_frameworks,
+            indicator_manifest,
+        )
+
+        cache = fingertips_cache(ttl=0) if self.incremental else fingertips_cache()
 
         # This is a lookup between framework_ids and the indicators they contain
         self.framework_metadata = {
-            _id: get_metadata_for_profile_as_dataframe(_id)
-            for _id in self.framework_ids
+            _id: fetch_profile_metadata(_id, cache=cache) for _id in self.framework_ids
         }
 
         # This gives us the list of ids to collect data from for each framework
@@ -74,62 +114,130 @@ class HealthIndicators(FlowSpec):
                 list,
             )
 
-        self.next(self.fetch_tables, foreach="indicator_ids")
+        self.indicator_frameworks = indicator_frameworks(self.framework_metadata)
+        self.metadata_manifest = indicator_manifest(self.framework_metadata)
+        self.previous_run = None
+
+        if self.incremental:
+            from afs_neighbourhood_analysis.utils.metaflow import get_run
+            from metaflow.exception import MetaflowNotFound
+
+            try:
+                run = get_run("HealthIndicators")
+            except MetaflowNotFound:
+                run = None
+
+            if run is not None and "manifest" in run.data:
+                self.previous_run = run.pathspec
+                changed = set(
+                    changed_indicators(self.metadata_manifest, run.data.manifest)
+                )
+                self.indicator_ids = [
+                    _id for _id in self.indicator_ids if _id in changed
+                ]
+                logging.info(
+                    f"Updating {run.pathspec}: {len(self.indicator_ids)} "
+                    "new or changed indicators"
+                )
+            else:
+                logging.info("No previous run with a manifest, fetching everything")
+
+        # foreach needs at least one item, so with nothing to fetch we
+        # have a single empty batch
+        self.indicator_batches = [
+            list(batch) for batch in partition_all(self.batch_size, self.indicator_ids)
+        ] or [[]]
+
+        self.next(self.fetch_tables, foreach="indicator_batches")
 
     @step
     def fetch_tables(self):
-        """Fetch indicator table"""
+        """Fetch a batch of indicator tables concurrently"""
 
-        # Robust fetch table tries to catch exceptions before they
+        # Robust fetch tables tries to catch exceptions before they
         # break the flow
-        from utils import robust_fetch_table
+        from utils import fingertips_cache, robust_fetch_tables
 
-        self.table = {self.input: robust_fetch_table(self.input)}
+        cache = fingertips_cache(ttl=0) if self.incremental else fingertips_cache()
+
+        self.tables = (
+            robust_fetch_tables(self.input, max_workers=self.max_workers, cache=cache)
+            if len(self.input) > 0
+            else {}
+        )
 
         self.next(self.join_indicators)
 
     @step
     def join_indicators(self, inputs):
-        """Joins all indicators in a framework"""
+        """Merges the tables fetched by each batch"""
 
         from utils import clean_fingertips_table
 
+        self.merge_artifacts(
+            inputs,
+            include=[
+                "framework_ids",
+                "indicator_frameworks",
+                "metadata_manifest",
+                "previous_run",
+            ],
+        )
+
         # Lookup between indicator ids and tables
-        self.indicator_tables = {
+        fetched_tables = {
             key: clean_fingertips_table(value)
             for input in inputs
-            for key, value in input.table.items()
+            for key, value in input.tables.items()
+        }
+
+        self.manifest = {
+            key: self.metadata_manifest[key]
+            for key, table in fetched_tables.items()
+            if table is not None
         }
 
+        # In incremental mode we keep the tables of unchanged indicators from
+        # the previous run, dropping indicators that are no longer published.
+        # If refetching a changed indicator failed we also keep its previous
+        # table, with its previous manifest entry so that the next
+        # incremental run tries it again
+        if self.previous_run is not None:
+            from metaflow import Run
+
+            previous = Run(self.previous_run).data
+            self.indicator_tables = {
+                key: table
+                for key, table in previous.indicator_tables.items()
+                if key in self.metadata_manifest
+                and (key not in fetched_tables or fetched_tables[key] is None)
+            }
+            for key, table in self.indicator_tables.items():
+                if table is not None:
+                    self.manifest[key] = previous.manifest[key]
+            for key, table in fetched_tables.items():
+                if self.indicator_tables.get(key) is None:
+                    self.indicator_tables[key] = table
+        else:
+            # Indicators we failed to fetch are left out of the manifest so
+            # that the next incremental run tries them again
+            self.indicator_tables = fetched_tables
+
         self.next(self.end)
 
     @step
     def end(self):
-        """Create dict lookup between framework ids and indicator tables"""
-        from fingertips_py import (
-            get_metadata_for_profile_as_dataframe,
-            get_all_profiles,
-        )
-
-        framework_ids = [fr["Id"] for fr in get_all_profiles()]
+        """Create dict lookup between framework ids and the ids of their
+        indicators. Tables are only stored once, in indicator_tables
+        """
 
-        framework_indicator_lookup = {
-            _id: set(
-                get_metadata_for_profile_as_dataframe(_id)["Indicator ID"].tolist()
-            )
-            for _id in framework_ids
-        }
+        self.framework_indicators = {frame_id: [] for frame_id in self.framework_ids}
 
-        # Lookup between framework ids and a list of its indicators
-
-        self.framework_tables = {
-            frame_id: [
-                t
-                for _id, t in self.indicator_tables.items()
-                if _id in framework_indicator_lookup[frame_id]
-            ]
-            for frame_id in framework_indicator_lookup.keys()
-        }
+        for _id, table in self.indicator_tables.items():
+            if table is None:
+                continue
+            for frame_id in self.indicator_frameworks.get(_id, []):
+                self.framework_indicators[frame_id].append(_id)
 
 
 if __name__ == "__main__":
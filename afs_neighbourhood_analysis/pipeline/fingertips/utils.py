@@ -1,11 +1,54 @@
+import hashlib
+import json
 import logging
+import os
 import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List
 from urllib3.exceptions import HTTPError
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 from pandas.errors import ParserError
 from fingertips_py import get_data_for_indicator_at_all_available_geographies
 
+from afs_neighbourhood_analysis import PROJECT_DIR
+from afs_neighbourhood_analysis.utils.http_cache import ResponseCache, make_session
+
+FINGERTIPS_API = "https://fingertips.phe.org.uk/api/"
+
+FINGERTIPS_CACHE_DIR = f"{PROJECT_DIR}/inputs/data/http_cache/fingertips"
+
+# Cached responses are revalidated with the API after a week
+FINGERTIPS_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Area type id for England, the parent area used by fingertips_py
+ENGLAND_AREA_TYPE = 15
+
+# Parquet dataset with the public health profile, partitioned by area type
+# and indicator. The csv is the format used before we moved to parquet
+PUBLIC_HEALTH_PROFILE_DIR = f"{PROJECT_DIR}/inputs/data/public_health_profile"
+PUBLIC_HEALTH_PROFILE_CSV = f"{PROJECT_DIR}/inputs/data/public_health_profile.csv"
+
+PUBLIC_HEALTH_PARTITIONS = ["area_type", "indicator_id"]
+
+# String columns with a few distinct values repeated across many rows
+PUBLIC_HEALTH_CATEGORIES = [
+    "indicator_name",
+    "area_code",
+    "area_name",
+    "area_type",
+    "sex",
+    "age",
+    "category_type",
+    "category",
+    "time_period",
+]
+
 
 def clean_fingertips_table(table: pd.DataFrame) -> pd.DataFrame:
     """Cleans up variables fingertips table"""
@@ -30,3 +73,298 @@ def robust_fetch_table(indicator_id: int, verbose: bool = False):
 
     except ParserError:
         logging.info(f"{indicator_id} pandas parsing error")
+
+
+def fingertips_cache(
+    cache_dir: str = FINGERTIPS_CACHE_DIR, ttl: float = FINGERTIPS_CACHE_TTL
+) -> ResponseCache:
+    """On-disk cache for fingertips API responses"""
+
+    return ResponseCache(cache_dir, ttl=ttl)
+
+
+def fetch_content(
+    url: str,
+    params: dict = None,
+    session: requests.Session = None,
+    cache: ResponseCache = None,
+) -> bytes:
+    """Body of a GET request, going through the cache if we have one"""
+
+    session = session or make_session()
+
+    if cache is not None:
+        return cache.get(url, params=params, session=session)
+
+    response = session.get(url, params=params)
+    response.raise_for_status()
+
+    return response.content
+
+
+def fetch_profiles(
+    session: requests.Session = None,
+    base_url: str = FINGERTIPS_API,
+    cache: ResponseCache = None,
+) -> List[dict]:
+    """All fingertips profiles (frameworks) with their ids and names"""
+
+    return json.loads(fetch_content(f"{base_url}profiles", None, session, cache))
+
+
+def fetch_profile_metadata(
+    profile_id: int,
+    session: requests.Session = None,
+    base_url: str = FINGERTIPS_API,
+    cache: ResponseCache = None,
+) -> pd.DataFrame:
+    """Metadata for the indicators in a profile.
+    Equivalent to get_metadata_for_profile_as_dataframe
+    """
+
+    return pd.read_csv(
+        BytesIO(
+            fetch_content(
+                f"{base_url}indicator_metadata/csv/by_profile_id",
+                {"profile_id": profile_id},
+                session,
+                cache,
+            )
+        )
+    )
+
+
+def fetch_available_data(
+    session: requests.Session = None,
+    base_url: str = FINGERTIPS_API,
+    cache: ResponseCache = None,
+) -> pd.DataFrame:
+    """Table with the area types each indicator is available for"""
+
+    return pd.DataFrame(
+        json.loads(fetch_content(f"{base_url}available_data", None, session, cache))
+    )
+
+
+def fetch_available_area_types(
+    session: requests.Session = None,
+    base_url: str = FINGERTIPS_API,
+    cache: ResponseCache = None,
+) -> Dict[int, List[int]]:
+    """Lookup between indicator ids and the area types they are available for"""
+
+    return (
+        fetch_available_data(session, base_url, cache)
+        .groupby("IndicatorId")["AreaTypeId"]
+        .apply(list)
+        .to_dict()
+    )
+
+
+def fetch_indicator_csv(
+    indicator_id: int,
+    area_type_ids: List[int],
+    session: requests.Session = None,
+    base_url: str = FINGERTIPS_API,
+    cache: ResponseCache = None,
+) -> pd.DataFrame:
+    """Fetches an indicator for all the area types where it is available.
+    Equivalent to get_data_for_indicator_at_all_available_geographies
+    using a shared session.
+    """
+
+    tables = [
+        pd.read_csv(
+            BytesIO(
+                fetch_content(
+                    f"{base_url}all_data/csv/by_indicator_id",
+                    {
+                        "indicator_ids": indicator_id,
+                        "child_area_type_id": area_type_id,
+                        "parent_area_type_id": ENGLAND_AREA_TYPE,
+                    },
+                    session,
+                    cache,
+                )
+            ),
+            low_memory=False,
+        )
+        for area_type_id in area_type_ids
+    ]
+
+    return pd.concat(tables).drop_duplicates()
+
+
+def robust_fetch_tables(
+    indicator_ids: List[int],
+    max_workers: int = 8,
+    session: requests.Session = None,
+    base_url: str = FINGERTIPS_API,
+    cache: ResponseCache = None,
+) -> Dict[int, pd.DataFrame]:
+    """Fetches indicators concurrently, catching errors like robust_fetch_table
+
+    Args:
+        indicator_ids: indicators to fetch
+        max_workers: maximum number of concurrent requests
+        session: session to use. By default we make one with max_workers
+            connections
+        base_url: url of the fingertips API
+        cache: optional response cache (see fingertips_cache)
+
+    Returns:
+        A lookup between indicator ids and tables (None if we could not
+            fetch the indicator)
+    """
+
+    session = session or make_session(max_connections=max_workers)
+    area_types = fetch_available_area_types(session, base_url, cache)
+
+    def _fetch(indicator_id: int):
+        if indicator_id not in area_types:
+            logging.info(f"{indicator_id} not available")
+            return None
+        try:
+            return fetch_indicator_csv(
+                indicator_id, area_types[indicator_id], session, base_url, cache
+            )
+        except requests.RequestException:
+            logging.info(f"{indicator_id} http error")
+        except ParserError:
+            logging.info(f"{indicator_id} pandas parsing error")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = dict(zip(indicator_ids, executor.map(_fetch, indicator_ids)))
+
+    if cache is not None:
+        logging.info(f"Fingertips cache: {cache.stats()}")
+
+    return tables
+
+
+def indicator_frameworks(
+    framework_metadata: Dict[int, pd.DataFrame],
+) -> Dict[int, List[int]]:
+    """Lookup between indicator ids and the frameworks that include them
+
+    Args:
+        framework_metadata: lookup between framework ids and their indicator
+            metadata (as returned by fetch_profile_metadata)
+    """
+
+    lookup = {}
+    for frame_id, metadata in framework_metadata.items():
+        for indicator_id in metadata["Indicator ID"].unique():
+            lookup.setdefault(int(indicator_id), []).append(frame_id)
+
+    return lookup
+
+
+def indicator_manifest(framework_metadata: Dict[int, pd.DataFrame]) -> Dict[int, str]:
+    """Fingerprint of the metadata of each indicator
+
+    Args:
+        framework_metadata: lookup between framework ids and their indicator
+            metadata (as returned by fetch_profile_metadata)
+
+    Returns:
+        A lookup between indicator ids and a hash of all their metadata rows.
+            The hash changes when fingertips updates an indicator (e.g. its
+            "Date updated" field)
+    """
+
+    rows = {}
+    for metadata in framework_metadata.values():
+        for indicator_id, row in zip(
+            metadata["Indicator ID"],
+            metadata.to_json(orient="records", lines=True).splitlines(),
+        ):
+            rows.setdefault(int(indicator_id), set()).add(row)
+
+    return {
+        indicator_id: hashlib.sha256("\n".join(sorted(r)).encode()).hexdigest()
+        for indicator_id, r in rows.items()
+    }
+
+
+def changed_indicators(
+    manifest: Dict[int, str], previous_manifest: Dict[int, str]
+) -> List[int]:
+    """Indicators that are new or whose metadata changed since a previous
+    manifest
+    """
+
+    return [
+        indicator_id
+        for indicator_id, fingerprint in manifest.items()
+        if previous_manifest.get(indicator_id) != fingerprint
+    ]
+
+
+def save_public_health_profile(
+    table: pd.DataFrame, path: str = PUBLIC_HEALTH_PROFILE_DIR
+):
+    """Saves a parsed public health table as a parquet dataset partitioned by
+    area type and indicator id, replacing any previous version
+    """
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    pq.write_to_dataset(
+        pa.Table.from_pandas(
+            table.astype(
+                {col: "category" for col in PUBLIC_HEALTH_CATEGORIES if col in table}
+            ),
+            preserve_index=False,
+        ),
+        path,
+        partition_cols=PUBLIC_HEALTH_PARTITIONS,
+    )
+
+
+def read_public_health_profile(
+    area_type: str = None,
+    columns: List[str] = None,
+    path: str = PUBLIC_HEALTH_PROFILE_DIR,
+    csv_path: str = PUBLIC_HEALTH_PROFILE_CSV,
+) -> pd.DataFrame:
+    """Reads the public health profile saved by save_public_health_profile
+
+    Args:
+        area_type: only read rows for this area type. With the parquet
+            dataset the other partitions are never read
+        columns: only read these columns
+        path: parquet dataset
+        csv_path: csv we read if there is no parquet dataset
+
+    Returns:
+        The public health profile table
+    """
+
+    if not os.path.exists(path):
+        logging.info(f"{path} not found, reading {csv_path}")
+        table = pd.read_csv(
+            csv_path,
+            usecols=None if columns is None else set(columns) | {"area_type"},
+        )
+        if area_type is not None:
+            table = table.loc[table["area_type"] == area_type]
+        return table[columns or table.columns].reset_index(drop=True)
+
+    table = pd.read_parquet(
+        path,
+        columns=columns,
+        filters=None if area_type is None else [("area_type", "==", area_type)],
+    )
+
+    # Partition values are read back as categories of strings
+    if "indicator_id" in table:
+        table["indicator_id"] = table["indicator_id"].astype(int)
+
+    # Categories can include values that only appear in the partitions
+    # we filtered out
+    for col in table.select_dtypes("category"):
+        table[col] = table[col].cat.remove_unused_categories()
+
+    return table.reset_index(drop=True)
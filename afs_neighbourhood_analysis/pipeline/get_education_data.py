@@ -2,22 +2,103 @@
 Functions to retrieve, unzip and download the education statistics regarding Early Years (in particular Good Levels of Development outcomes and the Early Years provision)
 """
 
-
-from bs4 import BeautifulSoup, SoupStrainer
+import html
 import json
+import logging
 import os
+import re
 import requests
-from io import BytesIO
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urljoin
 from zipfile import ZipFile
 import pandas as pd
 
 from afs_neighbourhood_analysis import PROJECT_DIR
+from afs_neighbourhood_analysis.utils.http_cache import ResponseCache, make_session
+from afs_neighbourhood_analysis.utils.remote_zip import (
+    HTTPRangeFile,
+    open_http_range,
+    range_size,
+)
+
+DFE_CACHE_DIR = f"{PROJECT_DIR}/inputs/data/http_cache/dfe"
+
+# Cached pages are revalidated after a day
+DFE_CACHE_TTL = 24 * 60 * 60
+
+# The urls of a collection are memoised for an hour in each process
+COLLECTION_EXPIRY = 60 * 60
+
+JSON_LD_RE = re.compile(
+    r"<script[^>]*type=[\"']application/ld\+json[\"'][^>]*>(.*?)</script>",
+    re.DOTALL | re.IGNORECASE,
+)
+HREF_RE = re.compile(
+    r"<a\s[^>]*?href\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.IGNORECASE
+)
+
+# Lookup between (collection url, keyword) and the time we found its urls and the urls
+collection_urls = {}
+
+
+def dfe_cache(
+    cache_dir: str = DFE_CACHE_DIR, ttl: float = DFE_CACHE_TTL
+) -> ResponseCache:
+    """On-disk cache for DfE and gov.uk pages"""
+    return ResponseCache(cache_dir, ttl=ttl)
 
 
-def get_urls(**kwargs):
+def fetch_page(
+    url: str, session: requests.Session = None, cache: ResponseCache = None
+) -> str:
+    """
+    Function to fetch the html of a page, going through the cache if we have one.
+    """
+    if cache is not None:
+        content = cache.get(url, session=session)
+    else:
+        content = (session or requests).get(url).content
+
+    return content.decode("utf-8", errors="replace")
+
+
+def extract_json_ld(page: str) -> dict:
+    """
+    Function to parse the first JSON-LD script of a page (None if there isn't one).
+    """
+    match = JSON_LD_RE.search(page)
+    return json.loads(match.group(1)) if match is not None else None
+
+
+def extract_hrefs(page: str) -> list:
+    """
+    Function to extract the (unescaped) href of every <a> tag in a page without parsing
+    the whole document.
+    """
+    return [
+        html.unescape(next(group for group in groups if group))
+        for groups in HREF_RE.findall(page)
+        if any(groups)
+    ]
+
+
+def get_urls(
+    session: requests.Session = None,
+    cache: ResponseCache = None,
+    expiry: float = COLLECTION_EXPIRY,
+    **kwargs,
+):
     """
     Function for retrieving the dataset urls from the gov.uk website.
 
+    The urls come from the hasPart block of the JSON-LD of the collection page, or
+    failing that from the links that contain `keyword`. They are memoised for `expiry`
+    seconds.
+
     Returns:
         array of urls
     """
@@ -25,93 +106,358 @@ def get_urls(**kwargs):
         "url",
         "https://www.gov.uk/government/collections/statistics-early-years-foundation-stage-profile",
     )
+    keyword = kwargs.get("keyword", "provision")
 
-    req = requests.get(url).content
+    found, urls = collection_urls.get((url, keyword), (None, None))
+    if found is not None and time.time() - found < expiry:
+        return urls
 
-    try:
-        soup = BeautifulSoup(req, "html.parser")
+    page = fetch_page(url, session, cache)
 
-        data = json.loads(soup.find("script", type="application/ld+json").string)
-        return [data["hasPart"][x]["sameAs"] for x in range(len(data["hasPart"]))]
-    except:
-        print("No links found hidden within scripts.")
-        pass
     try:
-        keyword = kwargs.get("keyword", "provision")
-        return [
-            link["href"]
-            for link in BeautifulSoup(
-                req, parse_only=SoupStrainer("a"), features="html.parser"
-            )
-            if hasattr(link, "href")
-            if keyword in link["href"] and "https" in link["href"]
+        urls = [part["sameAs"] for part in extract_json_ld(page)["hasPart"]]
+    except (TypeError, KeyError, ValueError):
+        print("No links found hidden within scripts.")
+        urls = [
+            href for href in extract_hrefs(page) if keyword in href and "https" in href
         ]
-    except:
-        print("Failed to get URLS")
-        pass
 
+    collection_urls[(url, keyword)] = (time.time(), urls)
+
+    return urls
 
-def get_links(url_):
+
+def get_links(url_, session: requests.Session = None, cache: ResponseCache = None):
     """
     Function for retrieving the individual dataset urls from a EYFSP webpage (see function get_urls_eyfsp).
 
     Returns:
         array of the urls of the individual datasets
     """
-    req = requests.get(url_).content
     return [
-        link["href"]
-        for link in BeautifulSoup(
-            req, parse_only=SoupStrainer("a"), features="html.parser"
-        )
-        if hasattr(link, "href")
-        if ".zip" in link["href"]
+        urljoin(url_, href)
+        for href in extract_hrefs(fetch_page(url_, session, cache))
+        if ".zip" in href
     ]
 
 
-def unzip_file_links(zip_url, **kwargs):
+def save_response(response: requests.Response, chunk_size: int = 1 << 20) -> str:
     """
-    Function to take the URLs of the Early Years datasets and unzip them, extracting the relevant files to /inputs/data/aux.
+    Function to stream the body of a response to a temporary file.
+
+    Returns:
+        path of the temporary file. The caller is responsible for removing it
     """
-    folder_name = kwargs.get("folder_name", "eyfsp")
-    extensions = kwargs.get("extensions", (".csv", ".xlsx"))
-    mute = kwargs.get("mute", False)
+    with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as outfile:
+        for chunk in response.iter_content(chunk_size):
+            outfile.write(chunk)
 
-    member_files = kwargs.get("member_files", None)
+    return outfile.name
+
+
+def download_zip(
+    zip_url: str, session: requests.Session = None, chunk_size: int = 1 << 20
+) -> str:
+    """
+    Function to stream a zip file to a temporary file without holding it in memory.
+
+    Returns:
+        path of the temporary file. The caller is responsible for removing it
+    """
+    with (session or requests).get(zip_url, stream=True) as response:
+        response.raise_for_status()
+        return save_response(response, chunk_size)
+
+
+def aux_folder(folder_name: str) -> str:
+    """Folder in inputs/data/aux where we extract the files of a dataset"""
+    return f"{PROJECT_DIR}/inputs/data/aux/{folder_name}"
+
+
+def open_zip(zip_url, session: requests.Session = None, ranges: bool = True):
+    """
+    Function to open a remote zip file, with range requests if the server supports
+    them or downloading it otherwise.
+
+    Returns:
+        a HTTPRangeFile or the path of a temporary copy of the archive
+    """
+    remote = open_http_range(zip_url, session) if ranges else None
+
+    return remote if remote is not None else download_zip(zip_url, session)
+
+
+def probe_zip(
+    zip_url, entry: dict = None, session: requests.Session = None, ranges: bool = True
+):
+    """
+    Function to check if a remote zip file changed since it was recorded in the manifest.
+
+    The conditional request asks for the first byte of the archive, so it also tells us
+    if the server supports range requests. If it doesn't, the response is the whole
+    archive, which we save.
+
+    Returns:
+        None if the archive didn't change. Otherwise its new manifest entry and a
+        source to read it from (see open_zip)
+    """
+    headers = {"Range": "bytes=0-0"} if ranges else {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    with (session or requests).get(zip_url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        size = range_size(response)
+        etag = response.headers.get("ETag")
+        if size is not None:
+            source = HTTPRangeFile(zip_url, size, session, etag=etag)
+        else:
+            source = save_response(response)
+            size = os.path.getsize(source)
+
+        new_entry = {
+            "etag": etag,
+            "last_modified": response.headers.get("Last-Modified"),
+            "size": size,
+        }
+
+    try:
+        new_entry["members"] = {
+            info.filename: info.CRC for info in ZipFile(source).infolist()
+        }
+    except BaseException:
+        if isinstance(source, str):
+            os.remove(source)
+        raise
+
+    return new_entry, source
 
-    req = requests.get(zip_url)
-    files = ZipFile(BytesIO(req.content))
+
+def wanted_members(members, **kwargs):
+    """
+    Function to select the members of an archive that we extract (see sync_archives).
+    """
+    member_files = kwargs.get("member_files", None)
 
     if member_files is None:
-        files_to_extract = [
-            file_ for file_ in files.namelist() if file_.endswith(extensions)
+        return [
+            member
+            for member in members
+            if member.endswith(kwargs.get("extensions", (".csv", ".xlsx")))
         ]
-        if mute == False:
-            print(f"files extracted : {files_to_extract}")
-        # Writing the zip file into local file system
-        files.extractall(
-            f"{PROJECT_DIR}/inputs/data/aux/{folder_name}", members=files_to_extract
-        )
-    else:
-        try:
-            extract_files = [
-                member_file_
-                for member_file_ in member_files
-                if member_file_ in files.namelist()
-            ]
-            files.extractall(
-                f"{PROJECT_DIR}/inputs/data/aux/{folder_name}", members=extract_files
-            )
-        except:
-            print("Failed to extract files.")
-            pass
+    return [member for member in member_files if member in members]
 
 
-def get_data(**kwargs):
+def manifest_path(folder_name: str) -> str:
+    """Manifest of the archives and files extracted into an aux folder"""
+    return f"{aux_folder(folder_name)}.manifest.json"
+
+
+def read_manifest(folder_name: str) -> dict:
+    """
+    Function to read the download manifest of an aux folder.
+
+    The manifest has two lookups:
+        archives: between zip urls and their ETag, Last-Modified, size and the CRC of
+            each member
+        files: between extracted files and the url and CRC of the member they come from
+    """
+    try:
+        with open(manifest_path(folder_name)) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {"archives": {}, "files": {}}
+
+
+def write_manifest(manifest: dict, folder_name: str):
+    """Function to save a download manifest, replacing the previous one atomically."""
+    path = manifest_path(folder_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(path), suffix=".tmp", delete=False
+    ) as outfile:
+        json.dump(manifest, outfile, indent=2)
+    os.replace(outfile.name, path)
+
+
+def sync_archives(
+    links,
+    session: requests.Session = None,
+    max_workers: int = 8,
+    ranges: bool = True,
+    **kwargs,
+):
+    """
+    Function to extract the relevant files of a list of zip files to /inputs/data/aux,
+    skipping the archives and members that didn't change since the last run.
+
+    1. Archives are checked concurrently with conditional requests. For archives that
+       changed we read the CRCs of their members.
+    2. Each file is assigned to the last archive (in the order of the links) that
+       contains it, as when we extracted every archive in turn.
+    3. We only extract the files whose archive or CRC differ from the ones in the
+       manifest (or that are missing), concurrently into staging folders that we then
+       move into place.
+    """
+    folder_name = kwargs.get("folder_name", "eyfsp")
+    path = aux_folder(folder_name)
+    manifest = read_manifest(folder_name)
+
+    sources = {}
+    staging_dirs = []
+    probes = []
+    extractions = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                links = list(dict.fromkeys(links))
+                probes = [
+                    executor.submit(
+                        probe_zip,
+                        link_,
+                        manifest["archives"].get(link_),
+                        session,
+                        ranges,
+                    )
+                    for link_ in links
+                ]
+                for link_, probe in zip(links, probes):
+                    if probe.result() is not None:
+                        manifest["archives"][link_], sources[link_] = probe.result()
+
+                owners = {
+                    member: link_
+                    for link_ in links
+                    for member in wanted_members(
+                        manifest["archives"][link_]["members"], **kwargs
+                    )
+                }
+                to_extract = {}
+                for member, link_ in owners.items():
+                    record = {
+                        "url": link_,
+                        "crc": manifest["archives"][link_]["members"][member],
+                    }
+                    if manifest["files"].get(member) != record or not os.path.exists(
+                        os.path.join(path, member)
+                    ):
+                        to_extract.setdefault(link_, []).append(member)
+
+                logging.info(
+                    f"{len(links) - len(sources)} of {len(links)} archives unchanged, "
+                    f"extracting {sum(len(m) for m in to_extract.values())} files"
+                )
+
+                def _extract(link_, members, staging_dir):
+                    source = sources.get(link_)
+                    if source is None:
+                        source = sources[link_] = open_zip(link_, session, ranges)
+                    ZipFile(source).extractall(staging_dir, members=members)
+                    if kwargs.get("mute", False) == False:
+                        print(f"files extracted : {members}")
+
+                staging_dirs = [staging_folder(path) for _ in to_extract]
+                extractions = [
+                    executor.submit(_extract, link_, members, staging_dir)
+                    for (link_, members), staging_dir in zip(
+                        to_extract.items(), staging_dirs
+                    )
+                ]
+
+                for extraction, (link_, members), staging_dir in zip(
+                    extractions, to_extract.items(), staging_dirs
+                ):
+                    extraction.result()
+                    move_members(staging_dir, path)
+                    for member in members:
+                        manifest["files"][member] = {
+                            "url": link_,
+                            "crc": manifest["archives"][link_]["members"][member],
+                        }
+            finally:
+                # Stops pending work if something failed. Leaving the with
+                # block waits for the work that already started
+                for future in probes + extractions:
+                    future.cancel()
+    finally:
+        # Downloaded copies of archives, including the ones from probes
+        # we didn't get to read because an earlier probe failed
+        downloaded = list(sources.values()) + [
+            probe.result()[1]
+            for probe in probes
+            if probe.done()
+            and not probe.cancelled()
+            and probe.exception() is None
+            and probe.result() is not None
+        ]
+        for source in downloaded:
+            if isinstance(source, str) and os.path.exists(source):
+                os.remove(source)
+        for staging_dir in staging_dirs:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        write_manifest(manifest, folder_name)
+
+
+def move_members(staging_dir: str, path: str):
+    """
+    Function to move extracted files from a staging folder to their destination,
+    replacing existing files.
+    """
+    for root, _, files in os.walk(staging_dir):
+        for file_ in files:
+            source = os.path.join(root, file_)
+            destination = os.path.join(path, os.path.relpath(source, staging_dir))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(source, destination)
+
+
+def staging_folder(path: str) -> str:
+    """Temporary folder next to `path` (so that moving files out of it is atomic)"""
+    os.makedirs(path, exist_ok=True)
+    return tempfile.mkdtemp(prefix=".staging_", dir=os.path.dirname(path))
+
+
+def unzip_file_links(zip_url, session: requests.Session = None, **kwargs):
+    """
+    Function to take the URLs of the Early Years datasets and unzip them, extracting the relevant files to /inputs/data/aux.
+    """
+    sync_archives([zip_url], session, max_workers=1, **kwargs)
+
+
+def get_data(
+    max_workers: int = 8,
+    session: requests.Session = None,
+    cache: ResponseCache = None,
+    **kwargs,
+):
     """
     Get the data from the DfE website regarding the Early Years: find the relevant URLs, unzip the files and extract to inputs/data/aux
+
+    Pages and zip files are fetched concurrently over a pooled session, and pages are
+    cached on disk (see dfe_cache). Archives and
+    files that didn't change since the last run are skipped (see sync_archives).
     """
+    session = session or make_session(max_connections=max_workers)
+
+    cache = cache or dfe_cache()
 
-    urls = get_urls(**kwargs)
+    urls = get_urls(session=session, cache=cache, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        links = [
+            link_
+            for links_ in executor.map(
+                partial(get_links, session=session, cache=cache), urls
+            )
+            for link_ in links_
+        ]
 
-    [unzip_file_links(link_, **kwargs) for url_ in urls for link_ in get_links(url_)]
+    sync_archives(links, session, max_workers, **kwargs)
@@ -0,0 +1,305 @@
+# Benchmarks for the LAD clustering pipeline on synthetic data
+#
+# Usage:
+#   python afs_neighbourhood_analysis/pipeline/lad_clustering/benchmark.py \
+#       --areas 150 1000 --features 100 --runs 10
+#
+# The report is saved as a json file in outputs/reports/benchmarks so that
+# results from different versions of the pipeline can be compared.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import product
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.cluster import AffinityPropagation, KMeans
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score
+from sklearn.mixture import GaussianMixture
+
+from afs_neighbourhood_analysis import PROJECT_DIR
+from afs_neighbourhood_analysis.pipeline.lad_clustering.cluster_utils import (
+    build_cluster_graph,
+    calculate_cluster_heterogeneity,
+    clustering_params,
+    extract_communities,
+    prepare_community_graph,
+    reduce_dim,
+)
+
+BENCHMARK_DIR = f"{PROJECT_DIR}/outputs/reports/benchmarks"
+
+EY_INDICATORS = [
+    "average_point_score",
+    "elg_percent",
+    "gld_percent",
+    "comm_lang_lit_percent",
+]
+
+
+def synthetic_lad_vectors(
+    n_areas: int, n_features: int, n_groups: int = 10, random_state: int = 0
+) -> pd.DataFrame:
+    """Synthetic area x indicator matrix with some cluster structure
+
+    Args:
+        n_areas: number of areas (rows)
+        n_features: number of indicators (columns)
+        n_groups: number of latent groups of areas
+        random_state: seed
+
+    Returns:
+        A dataframe indexed by fake area codes
+    """
+
+    vectors, _ = make_blobs(
+        n_samples=n_areas,
+        n_features=n_features,
+        centers=n_groups,
+        random_state=random_state,
+    )
+
+    return pd.DataFrame(
+        vectors,
+        index=[f"E{n:08d}" for n in range(n_areas)],
+        columns=[f"indicator_{n}" for n in range(n_features)],
+    )
+
+
+def synthetic_early_years(area_codes: list, random_state: int = 0) -> pd.DataFrame:
+    """Synthetic standardised early years table for a list of areas, in the
+    format returned by standardise_early_years
+    """
+
+    rng = np.random.default_rng(random_state)
+
+    return pd.DataFrame(
+        [
+            [code, indicator, gender]
+            for code, indicator, gender in product(
+                area_codes, EY_INDICATORS, ["Total", "Girls", "Boys"]
+            )
+        ],
+        columns=["new_la_code", "indicator", "gender"],
+    ).assign(zscore=lambda df: rng.normal(size=len(df)))
+
+
+def measure_stage(stage: Callable, repeats: int = 1) -> tuple:
+    """Measures the wall time and peak memory of a stage
+
+    Wall time is the fastest of `repeats` untraced runs. Peak memory is
+    measured with tracemalloc in an additional run, so tracing doesn't
+    inflate the times.
+
+    Returns:
+        The output of the stage and a dict with its metrics
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    output = stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return output, {"wall_time_s": min(times), "peak_memory_mb": peak / 1e6}
+
+
+def benchmark_clustering(
+    n_areas: int,
+    n_features: int,
+    n_runs: int,
+    clustering_options: list,
+    pca: int = 20,
+    resolutions: list = (1.0,),
+    repeats: int = 1,
+) -> dict:
+    """Benchmarks every stage of the LAD clustering pipeline for one data size
+
+    Community detection is timed over all the resolutions, as in the grid
+    search. The backends don't return identical partitions, so we also
+    compare their number of communities and adjusted Rand index at each
+    resolution.
+
+    Returns:
+        A dict with the settings, the metrics of each stage and the
+        agreement between community backends
+    """
+
+    logging.info(f"Benchmarking {n_areas} areas, {n_features} features")
+
+    lad_vector = synthetic_lad_vectors(n_areas, n_features)
+    early_years = synthetic_early_years(lad_vector.index.tolist())
+
+    stages = {}
+
+    lad_reduced, stages["reduce_dim"] = measure_stage(
+        lambda: reduce_dim(lad_vector, n_components_pca=min(pca, n_features)),
+        repeats,
+    )
+    (cluster_graph, index_lookup), stages["build_cluster_graph"] = measure_stage(
+        lambda: build_cluster_graph(
+            lad_reduced, clustering_options, n_runs=n_runs, random_state=0
+        ),
+        repeats,
+    )
+
+    backend_lookups = {}
+    for backend in ["python-louvain", "csr-louvain"]:
+        community_graph = prepare_community_graph(cluster_graph, backend)
+        cluster_lookups, stages[f"extract_communities_{backend}"] = measure_stage(
+            lambda: [
+                extract_communities(
+                    community_graph, resolution, index_lookup, backend, random_state=0
+                )
+                for resolution in resolutions
+            ],
+            repeats,
+        )
+        backend_lookups[backend] = cluster_lookups
+
+    _, stages["calculate_cluster_heterogeneity"] = measure_stage(
+        lambda: calculate_cluster_heterogeneity(early_years, cluster_lookups[-1]),
+        repeats,
+    )
+
+    backend_agreement = []
+    for n, resolution in enumerate(resolutions):
+        python_lookup = backend_lookups["python-louvain"][n]
+        csr_lookup = backend_lookups["csr-louvain"][n]
+        areas = list(python_lookup.keys())
+        backend_agreement.append(
+            {
+                "resolution": float(resolution),
+                "n_communities": {
+                    backend: len(set(lookups[n].values()))
+                    for backend, lookups in backend_lookups.items()
+                },
+                "adjusted_rand": adjusted_rand_score(
+                    [python_lookup[area] for area in areas],
+                    [csr_lookup[area] for area in areas],
+                ),
+            }
+        )
+
+    return {
+        "n_areas": n_areas,
+        "n_features": n_features,
+        "n_runs": n_runs,
+        "pca": pca,
+        "resolutions": [float(resolution) for resolution in resolutions],
+        "stages": stages,
+        "backend_agreement": backend_agreement,
+    }
+
+
+def environment_info() -> dict:
+    """Versions and commit the benchmark ran with"""
+
+    try:
+        commit = (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def select_algorithms(names: list) -> list:
+    """Subset of clustering_params for the algorithms in names"""
+
+    algorithms = {
+        "kmeans": KMeans,
+        "affinity_propagation": AffinityPropagation,
+        "gaussian_mixture": GaussianMixture,
+    }
+
+    return [cl for cl in clustering_params if cl[0] in {algorithms[n] for n in names}]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the LAD clustering pipeline on synthetic data"
+    )
+    parser.add_argument("--areas", type=int, nargs="+", default=[150])
+    parser.add_argument("--features", type=int, nargs="+", default=[100])
+    parser.add_argument("--runs", type=int, nargs="+", default=[10])
+    parser.add_argument(
+        "--algorithms",
+        nargs="+",
+        default=["kmeans", "affinity_propagation", "gaussian_mixture"],
+        choices=["kmeans", "affinity_propagation", "gaussian_mixture"],
+    )
+    parser.add_argument("--pca", type=int, default=20)
+    parser.add_argument(
+        "--resolutions",
+        type=float,
+        nargs="+",
+        default=np.arange(0.4, 1.1, 0.1).round(1).tolist(),
+    )
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    clustering_options = select_algorithms(args.algorithms)
+
+    # UMAP compiles its numba functions the first time it runs. We do it
+    # before benchmarking so that compilation isn't counted as run time
+    reduce_dim(synthetic_lad_vectors(50, 10), n_components_pca=5)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment_info(),
+        "algorithms": args.algorithms,
+        "results": [
+            benchmark_clustering(
+                n_areas,
+                n_features,
+                n_runs,
+                clustering_options,
+                pca=args.pca,
+                resolutions=args.resolutions,
+                repeats=args.repeats,
+            )
+            for n_areas, n_features, n_runs in product(
+                args.areas, args.features, args.runs
+            )
+        ],
+    }
+
+    output = args.output or (
+        f"{BENCHMARK_DIR}/lad_clustering_{datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    with open(output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+
+    logging.info(f"Benchmark report saved in {output}")
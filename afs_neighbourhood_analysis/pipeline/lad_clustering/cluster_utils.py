@@ -1,19 +1,34 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
 import re
 import logging
-from collections import Counter
-from itertools import product, combinations
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from itertools import product
+from pathlib import Path
+from typing import List, Union
 
 import networkx as nx
 import numpy as np
 import pandas as pd
 from community import community_louvain
+from scipy import sparse as sp
 from sklearn.cluster import AffinityPropagation, KMeans
 from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
+from sklearn.metrics import pairwise_distances
+from sklearn.metrics.pairwise import euclidean_distances
 from sklearn.mixture import GaussianMixture
 from toolz import pipe
 from umap import UMAP
 
+from afs_neighbourhood_analysis.pipeline.lad_clustering.louvain import (
+    csr_graph,
+    louvain_communities,
+)
+
 
 # %%
 def parse_phf(phf_table):
@@ -71,6 +86,14 @@ def clustering_consequential_pipe(
     # Calculate silhouette scores
     het = calculate_cluster_heterogeneity(efsyp_indicator, cluster_lookup)
 
+    return clustering_result(pca, comm_resolution, cluster_lookup, het)
+
+
+def clustering_result(
+    pca: int, comm_resolution: float, cluster_lookup: dict, het: tuple
+) -> dict:
+    """Diagnostics for a clustering solution"""
+
     return {
         "pca": pca,
         "comm_resolution": comm_resolution,
@@ -79,12 +102,308 @@ def clustering_consequential_pipe(
     }
 
 
+def clustering_grid_search(
+    lad_vector: pd.DataFrame,
+    pca_values: list,
+    resolutions: list,
+    efsyp_indicator: pd.DataFrame,
+    clustering_options: list,
+    cache_dir: str = None,
+    results_path: str = None,
+    n_workers: int = 1,
+    community_backend: str = "python-louvain",
+    gender: str = "Total",
+    **ensemble_kwargs,
+) -> list:
+    """Runs the consequential clustering pipeline over a parameter grid.
+
+    The dimensionality reduction and the cluster graph only depend on the
+    number of PCA components, so they are computed once per pca value and
+    reused for every community resolution. Each pca value is a separate
+    job, and jobs can run across a process pool.
+
+    Args:
+        lad_vector: features to cluster
+        pca_values: numbers of PCA components to search over
+        resolutions: community detection resolutions to search over
+        efsyp_indicator: early years indicators used to evaluate the clusters
+        clustering_options: clustering algorithms and parameters in the ensemble
+        cache_dir: if given, cluster graphs are persisted there and reused
+            in later runs with the same inputs
+        results_path: if given, results are appended to this jsonl file as
+            they complete. Configurations already in it are skipped if they
+            were run with the same inputs, early years indicators and
+            community backend
+        n_workers: number of processes running pca values in parallel
+        community_backend: community detection backend (see community_backends)
+        gender: gender of the early years indicators used to evaluate the
+            clusters
+        ensemble_kwargs: other arguments passed to build_cluster_graph
+
+    Returns:
+        A list with the diagnostics of each (pca, resolution) pair. Each
+        result records the clustering_key of its inputs, the scoring_key of
+        the early years indicators and the community_backend
+    """
+
+    results = []
+
+    # Saved results are only reused if they were run with the same settings
+    scoring_key = scoring_cache_key(efsyp_indicator, gender)
+    settings = {
+        int(pca): {
+            "clustering_key": clustering_cache_key(
+                lad_vector, int(pca), clustering_options, **ensemble_kwargs
+            ),
+            "scoring_key": scoring_key,
+            "community_backend": community_backend,
+        }
+        for pca in pca_values
+    }
+
+    if results_path is not None and os.path.exists(results_path):
+        results = [
+            r
+            for r in read_grid_search_results(results_path)
+            if r["pca"] in settings
+            and all(r.get(k) == v for k, v in settings[r["pca"]].items())
+        ]
+        logging.info(f"Skipping {len(results)} completed configurations")
+
+    completed = {(r["pca"], r["comm_resolution"]) for r in results}
+    pending = {
+        pca: [
+            float(res) for res in resolutions if (int(pca), float(res)) not in completed
+        ]
+        for pca in pca_values
+    }
+    pending = {pca: res for pca, res in pending.items() if len(res) > 0}
+
+    if len(pending) == 0:
+        return results
+
+    # PCA is fitted once at the largest number of components and sliced
+    pca_vectors = fit_pca(lad_vector, max(pending.keys()))
+
+    stage = partial(
+        grid_search_stage,
+        lad_vector=lad_vector,
+        scorer=ClusterScorer(efsyp_indicator, gender),
+        clustering_options=clustering_options,
+        cache_dir=cache_dir,
+        pca_vectors=pca_vectors,
+        community_backend=community_backend,
+        **ensemble_kwargs,
+    )
+
+    def _collect(stage_results: list):
+        for r in stage_results:
+            r.update(settings[r["pca"]])
+        if results_path is not None:
+            append_grid_search_results(stage_results, results_path)
+        results.extend(stage_results)
+
+    if n_workers == 1:
+        for pca, res in pending.items():
+            _collect(stage(pca, res))
+    else:
+        # Workers are spawned rather than forked: forking a process where
+        # UMAP (numba) has run leaves it hanging at exit
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [executor.submit(stage, pca, res) for pca, res in pending.items()]
+            for future in as_completed(futures):
+                _collect(future.result())
+
+    return results
+
+
+def grid_search_stage(
+    pca: int,
+    resolutions: list,
+    lad_vector: pd.DataFrame,
+    scorer: "ClusterScorer",
+    clustering_options: list,
+    cache_dir: str = None,
+    pca_vectors: pd.DataFrame = None,
+    community_backend: str = "python-louvain",
+    **ensemble_kwargs,
+) -> list:
+    """Evaluates all the resolutions for one pca value of the grid search"""
+
+    lad_reduced, cluster_graph, index_lookup = prepare_clustering(
+        lad_vector,
+        pca,
+        clustering_options,
+        cache_dir,
+        pca_vectors=pca_vectors,
+        **ensemble_kwargs,
+    )
+    community_graph = prepare_community_graph(cluster_graph, community_backend)
+
+    cluster_lookups = [
+        extract_communities(
+            community_graph, comm_resolution, index_lookup, community_backend
+        )
+        for comm_resolution in resolutions
+    ]
+
+    return [
+        clustering_result(int(pca), float(comm_resolution), cluster_lookup, het)
+        for comm_resolution, cluster_lookup, het in zip(
+            resolutions, cluster_lookups, scorer.score_many(cluster_lookups)
+        )
+    ]
+
+
+def append_grid_search_results(results: list, results_path: str):
+    """Appends grid search results to a jsonl file, one row per configuration"""
+
+    # An interrupted run can leave an incomplete last row without a newline
+    if os.path.exists(results_path) and os.path.getsize(results_path) > 0:
+        with open(results_path, "rb") as infile:
+            infile.seek(-1, os.SEEK_END)
+            complete_last_row = infile.read() == b"\n"
+    else:
+        complete_last_row = True
+
+    with open(results_path, "a") as outfile:
+        if not complete_last_row:
+            outfile.write("\n")
+        for r in results:
+            record = {
+                "pca": int(r["pca"]),
+                "comm_resolution": float(r["comm_resolution"]),
+                "num_clusters": int(r["num_clusters"]),
+                "sil": [float(r["sil"][0]), r["sil"][1].astype(float).to_dict()],
+            }
+            for setting in ["clustering_key", "scoring_key", "community_backend"]:
+                if setting in r:
+                    record[setting] = r[setting]
+            outfile.write(json.dumps(record) + "\n")
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+def read_grid_search_results(results_path: str) -> list:
+    """Reads grid search results saved with append_grid_search_results.
+    Rows that were left incomplete by an interrupted run are ignored.
+    """
+
+    results = []
+
+    with open(results_path, "r") as infile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.info("Skipping incomplete grid search result")
+                continue
+
+            sil, variance = record["sil"]
+            record["sil"] = (
+                sil,
+                pd.Series(variance, index=pd.Index(variance.keys(), name="indicator")),
+            )
+            results.append(record)
+
+    return results
+
+
+def clustering_cache_key(
+    lad_vector: pd.DataFrame, pca: int, clustering_options: list, **ensemble_kwargs
+) -> str:
+    """Hash of the inputs that determine a cluster graph. n_jobs is left out
+    as it doesn't change the graph (see run_ensemble)
+    """
+
+    key = hashlib.sha256(
+        pd.util.hash_pandas_object(lad_vector, index=True).to_numpy().tobytes()
+    )
+    key.update(
+        repr(
+            (
+                list(lad_vector.columns),
+                pca,
+                clustering_options,
+                sorted(
+                    (name, value)
+                    for name, value in ensemble_kwargs.items()
+                    if name != "n_jobs"
+                ),
+            )
+        ).encode()
+    )
+
+    return key.hexdigest()
+
+
+def scoring_cache_key(efsyp_indicator: pd.DataFrame, gender: str = "Total") -> str:
+    """Hash of the early years indicators that clusters are scored against"""
+
+    key = hashlib.sha256(
+        pd.util.hash_pandas_object(efsyp_indicator, index=True).to_numpy().tobytes()
+    )
+    key.update(repr((list(efsyp_indicator.columns), gender)).encode())
+
+    return key.hexdigest()
+
+
+def prepare_clustering(
+    lad_vector: pd.DataFrame,
+    pca: int,
+    clustering_options: list,
+    cache_dir: str = None,
+    pca_vectors: pd.DataFrame = None,
+    **ensemble_kwargs,
+) -> tuple:
+    """Runs the stages of the pipeline that don't depend on the community
+    resolution: dimensionality reduction and the cluster ensemble
+
+    Args:
+        lad_vector: features to cluster
+        pca: number of PCA components
+        clustering_options: clustering algorithms and parameters in the ensemble
+        cache_dir: optional directory where outputs are cached by input hash
+        pca_vectors: optional precomputed PCA projection (see fit_pca)
+        ensemble_kwargs: other arguments passed to build_cluster_graph
+
+    Returns:
+        The reduced vectors, the cluster graph and the index lookup
+    """
+
+    if cache_dir is not None:
+        cache_path = Path(cache_dir) / (
+            clustering_cache_key(lad_vector, pca, clustering_options, **ensemble_kwargs)
+            + ".p"
+        )
+
+        if cache_path.exists():
+            logging.info(f"Reading cluster graph for pca={pca} from cache")
+            with open(cache_path, "rb") as infile:
+                return pickle.load(infile)
+
+    lad_reduced = reduce_dim(lad_vector, n_components_pca=pca, pca_vectors=pca_vectors)
+    clustering, indices = build_cluster_graph(
+        lad_reduced, clustering_options, **ensemble_kwargs
+    )
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "wb") as outfile:
+            pickle.dump((lad_reduced, clustering, indices), outfile)
+
+    return lad_reduced, clustering, indices
+
+
 def extract_clusters(
     lad_vector: pd.DataFrame, pca: int, comm_resolution: float, clustering_options: dict
 ):
     """Function to extract cluster lookups and positions"""
-    lad_reduced = reduce_dim(lad_vector, n_components_pca=pca)
-    clustering, indices = build_cluster_graph(lad_reduced, clustering_options)
+    lad_reduced, clustering, indices = prepare_clustering(
+        lad_vector, pca, clustering_options
+    )
     lad_cluster_lookup = extract_communities(clustering, comm_resolution, indices)
 
     umap_df = lad_reduced.assign(
@@ -99,53 +418,510 @@ def calculate_cluster_heterogeneity(secondary, clusters, gender="Total"):
     based on clusters
     """
 
-    second_long = (
-        secondary.query("gender == 'Total'")
-        .pivot_table(index="new_la_code", columns="indicator", values="zscore")
-        .dropna(axis=0)
-    )
+    return ClusterScorer(secondary, gender).score(clusters)
 
-    second_w_clusters = second_long.assign(
-        cluster=lambda df: df.index.map(clusters)
-    ).dropna(axis=0)
 
-    sil_sec = silhouette_score(
-        second_w_clusters[second_long.columns], second_w_clusters["cluster"]
-    )
+class ClusterScorer:
+    """Scores clusterings against secondary (early years) indicators.
 
-    intra_cluster_variance = (
-        second_w_clusters.reset_index(drop=False)
-        .melt(id_vars=["cluster", "new_la_code"])
-        .groupby("indicator")
-        .apply(lambda df: df.groupby("cluster")["value"].mean().var())
-    )
+    The secondary indicators don't change across the grid search, so we pivot
+    them and calculate their pairwise distances once. Silhouette scores and
+    variances for many clusterings are then calculated in a batch from the
+    cached distances.
+
+    Attributes:
+        indicators: LAs x indicators matrix of indicator z-scores
+        distances: euclidean distances between LAs in indicators
+    """
+
+    def __init__(self, secondary: pd.DataFrame, gender: str = "Total"):
+        self.indicators = (
+            secondary.query(f"gender == '{gender}'")
+            .pivot_table(index="new_la_code", columns="indicator", values="zscore")
+            .dropna(axis=0)
+        )
+        self.distances = pairwise_distances(self.indicators.to_numpy())
+
+    def score(self, clusters: dict) -> tuple:
+        """Silhouette score and variance between cluster means for one
+        lookup between LAs and clusters
+        """
+
+        return self.score_many([clusters])[0]
+
+    def score_many(self, cluster_lookups: list) -> list:
+        """Scores a list of lookups between LAs and clusters
+
+        Returns:
+            A list with the silhouette score and the variance between cluster
+                means of each indicator, for each clustering
+        """
+
+        encoded = [self._encode(clusters) for clusters in cluster_lookups]
+
+        # One product gives the sum of distances between every LA and
+        # every cluster of every clustering
+        cluster_distances = self.distances @ np.hstack(
+            [onehot for _, onehot in encoded]
+        )
+
+        scores = []
+        start = 0
+        for codes, onehot in encoded:
+            end = start + onehot.shape[1]
+            scores.append(
+                (
+                    self._silhouette(codes, onehot, cluster_distances[:, start:end]),
+                    self._variance(codes, onehot),
+                )
+            )
+            start = end
+
+        return scores
+
+    def _encode(self, clusters: dict) -> tuple:
+        """Cluster codes (-1 for LAs without a cluster) and one-hot matrix"""
+
+        codes, _ = pd.factorize(self.indicators.index.map(clusters))
+        onehot = np.zeros((len(codes), codes.max() + 1))
+        onehot[np.flatnonzero(codes >= 0), codes[codes >= 0]] = 1
+
+        return codes, onehot
+
+    def _silhouette(
+        self, codes: np.ndarray, onehot: np.ndarray, cluster_distances: np.ndarray
+    ) -> float:
+        """Silhouette score from the sums of distances to each cluster.
+        Follows sklearn.metrics.silhouette_score
+        """
+
+        keep = codes >= 0
+        codes, cluster_distances = codes[keep], cluster_distances[keep]
+        sizes = onehot.sum(axis=0)
+
+        if not 1 < len(sizes) < len(codes):
+            raise ValueError(
+                f"Number of labels is {len(sizes)}. Valid values are 2 "
+                "to n_samples - 1 (inclusive)"
+            )
+
+        rows = np.arange(len(codes))
+        own_size = sizes[codes]
 
-    return sil_sec, intra_cluster_variance
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intra = cluster_distances[rows, codes] / (own_size - 1)
+            mean_distances = cluster_distances / sizes
+            mean_distances[rows, codes] = np.inf
+            inter = mean_distances.min(axis=1)
+            silhouette = np.nan_to_num((inter - intra) / np.maximum(intra, inter))
+
+        # LAs in singleton clusters have a silhouette of 0
+        return float(np.mean(np.where(own_size > 1, silhouette, 0)))
+
+    def _variance(self, codes: np.ndarray, onehot: np.ndarray) -> pd.Series:
+        """Variance between cluster means for each indicator"""
+
+        cluster_means = (onehot.T @ self.indicators.to_numpy()) / onehot.sum(axis=0)[
+            :, None
+        ]
+
+        return pd.Series(
+            cluster_means.var(axis=0, ddof=1),
+            index=pd.Index(self.indicators.columns, name="indicator"),
+        )
+
+
+def fit_pca(lad_vector: pd.DataFrame, n_components: int) -> pd.DataFrame:
+    """Projects vectors onto their leading principal components.
+
+    We use the full SVD so that the projection on the first n components is
+    the same whatever the number of components fitted. This means that a
+    single fit at the largest n we need can be sliced for any smaller n.
+
+    Args:
+        lad_vector: vectors to project
+        n_components: maximum number of components we will need
+
+    Returns:
+        A dataframe with one column per principal component
+    """
+
+    pca = PCA(n_components=min(n_components, *lad_vector.shape), svd_solver="full")
+
+    return pd.DataFrame(pca.fit_transform(lad_vector), index=lad_vector.index)
 
 
 def reduce_dim(
-    lad_vector: pd.DataFrame, n_components_pca: int = 50, n_components_umap: int = 2
+    lad_vector: pd.DataFrame,
+    n_components_pca: int = 50,
+    n_components_umap: int = 2,
+    pca_vectors: pd.DataFrame = None,
 ) -> pd.DataFrame:
-    """Reduce dimensionality of sectoral distribution first via PCA and then via UMAP"""
+    """Reduce dimensionality of sectoral distribution first via PCA and then via UMAP
 
-    pca = PCA(n_components=n_components_pca)
+    Args:
+        lad_vector: vectors to reduce
+        n_components_pca: number of PCA components
+        n_components_umap: number of UMAP components
+        pca_vectors: optional output of fit_pca with at least n_components_pca
+            components. If given we slice it instead of refitting the PCA
+    """
+
+    if pca_vectors is None:
+        pca = PCA(n_components=n_components_pca)
+        pca_vectors = pd.DataFrame(
+            pca.fit_transform(lad_vector), index=lad_vector.index
+        )
 
     return pipe(
-        lad_vector,
-        lambda df: pd.DataFrame(pca.fit_transform(lad_vector), index=lad_vector.index),
-        lambda df: pd.DataFrame(
-            UMAP(n_components=n_components_umap).fit_transform(df),
-            index=df.index,
+        # Slicing the array rather than the dataframe avoids a copy
+        pca_vectors.to_numpy()[:, :n_components_pca],
+        lambda array: pd.DataFrame(
+            UMAP(n_components=n_components_umap).fit_transform(array),
+            index=lad_vector.index,
             columns=["x", "y"],
         ),
     )
 
 
+def label_matrix(labels: np.ndarray, weight: int = 1) -> sp.csr_matrix:
+    """One-hot encodes a vector of cluster labels
+
+    Args:
+        labels: cluster assignment for each observation. Negative labels
+            mark observations that were left out of the clustering run
+        weight: value of the non-zero entries, i.e. the number of runs
+            this label vector stands for
+
+    Returns:
+        A sparse observations x clusters matrix with a one (or weight) where
+            an observation belongs to a cluster
+    """
+
+    labels = np.asarray(labels)
+    clustered = np.flatnonzero(labels >= 0)
+    _, cluster_index = np.unique(labels[clustered], return_inverse=True)
+
+    return sp.csr_matrix(
+        (
+            np.full(len(clustered), weight, dtype=np.int32),
+            (clustered, cluster_index.ravel()),
+        ),
+        shape=(len(labels), cluster_index.max() + 1 if len(clustered) else 0),
+    )
+
+
+def coassociation_matrix(
+    cluster_labels: List[np.ndarray],
+    weights: List[int] = None,
+    sparse: bool = False,
+    min_count: int = None,
+    top_k: int = None,
+    block_size: int = 1024,
+) -> Union[np.ndarray, sp.csr_matrix]:
+    """Counts how many times each pair of observations is clustered together
+
+    The matrix is built in blocks of rows which are pruned before they are
+    stacked, so with min_count or top_k the memory we need is bounded by
+    the number of edges we keep rather than by n^2.
+
+    Args:
+        cluster_labels: list of label vectors, one per clustering run
+        weights: number of runs each label vector stands for. Defaults to one
+        sparse: if True return a scipy CSR matrix, otherwise a dense array
+        min_count: drop pairs clustered together fewer than min_count times
+        top_k: only keep the top_k most frequent co-occurrences of each
+            observation. The matrix is symmetrised afterwards so a pair is
+            kept if it is in the top_k of either observation
+        block_size: number of rows in each block
+
+    Returns:
+        A symmetric n x n matrix of co-occurrence counts with a zero diagonal
+    """
+
+    # Stacking the one-hot matrices of all runs side by side means that
+    # a product L @ L.T sums the co-occurrences over every run
+    if weights is None:
+        weights = [1] * len(cluster_labels)
+
+    labels_onehot = sp.hstack(
+        [
+            # The weight goes in one side of the product only
+            label_matrix(labels, weight)
+            for labels, weight in zip(cluster_labels, weights)
+        ],
+        format="csr",
+    )
+    labels_onehot_t = sp.hstack(
+        [label_matrix(labels) for labels in cluster_labels], format="csr"
+    ).T.tocsc()
+
+    blocks = [
+        prune_coassociation(
+            (labels_onehot[start : start + block_size] @ labels_onehot_t).tocsr(),
+            start,
+            min_count,
+            top_k,
+        )
+        for start in range(0, labels_onehot.shape[0], block_size)
+    ]
+    coassociation = sp.vstack(blocks, format="csr")
+
+    if top_k is not None:
+        coassociation = coassociation.maximum(coassociation.T).tocsr()
+
+    return coassociation if sparse else coassociation.toarray()
+
+
+def prune_coassociation(
+    block: sp.csr_matrix, row_offset: int, min_count: int = None, top_k: int = None
+) -> sp.csr_matrix:
+    """Removes self co-occurrences and weak pairs from a block of rows
+    of the co-association matrix
+
+    Args:
+        block: rows of the co-association matrix
+        row_offset: position of the first row of the block in the matrix
+        min_count: drop pairs clustered together fewer than min_count times
+        top_k: number of co-occurrences to keep per row
+
+    Returns:
+        The pruned block
+    """
+
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    block.data[block.indices == rows + row_offset] = 0
+
+    if min_count is not None:
+        block.data[block.data < min_count] = 0
+
+    if top_k is not None:
+        for row in range(block.shape[0]):
+            row_data = block.data[block.indptr[row] : block.indptr[row + 1]]
+            if len(row_data) > top_k:
+                row_data[np.argpartition(row_data, -top_k)[:-top_k]] = 0
+
+    block.eliminate_zeros()
+
+    return block
+
+
+def coassociation_graph(coassociation: Union[np.ndarray, sp.spmatrix]) -> nx.Graph:
+    """Builds a weighted network from a co-association matrix
+
+    Args:
+        coassociation: symmetric matrix of co-occurrence counts
+
+    Returns:
+        A network where nodes are observations with at least one co-occurrence
+            and edge weights are their number of co-occurrences
+    """
+
+    edges = sp.triu(sp.coo_matrix(coassociation), k=1)
+
+    cluster_graph = nx.Graph()
+    cluster_graph.add_weighted_edges_from(
+        zip(edges.row.tolist(), edges.col.tolist(), edges.data.tolist())
+    )
+
+    return cluster_graph
+
+
+def negative_squared_distances(vectors: np.ndarray) -> np.ndarray:
+    """Similarity used by AffinityPropagation with euclidean affinity"""
+
+    return -euclidean_distances(vectors, squared=True)
+
+
+# Algorithms whose output is fixed for a given input. We fit them once
+# and count their result n_runs times unless we are subsampling
+deterministic_algorithms = [AffinityPropagation]
+
+# Algorithms that can take a precomputed similarity matrix, which we calculate
+# once and reuse for every parameter value and run
+precomputed_affinities = {AffinityPropagation: negative_squared_distances}
+
+
+def ensemble_tasks(
+    clustering_algorithms: list,
+    n_runs: int = 10,
+    random_state: int = None,
+    n_obs: int = None,
+    sample: int = None,
+    bootstrap: bool = False,
+) -> list:
+    """Lists every model fit in the clustering ensemble
+
+    Args:
+        clustering_algorithms: a list where the first element is the clustering
+            algorithm and the second element are the parameter names and sets
+        n_runs: number of times to run a clustering algorithm
+        random_state: seed used to draw one seed (and subsample) per fit.
+            If None the fits are not seeded
+        n_obs: number of observations, needed to subsample
+        sample: if given, each run clusters a random subsample of this size
+        bootstrap: sample with replacement. If sample is None the bootstrap
+            samples have n_obs observations
+
+    Returns:
+        A list of (algorithm, parameters, seed, rows, weight) tuples in a fixed
+            order where rows are the subsampled observations (None for all)
+            and weight is the number of runs the fit stands for
+    """
+
+    subsample = sample is not None or bootstrap
+
+    tasks = []
+    for cl in clustering_algorithms:
+        algo = cl[0]
+        if algo in deterministic_algorithms and not subsample:
+            runs, weight = 1, n_runs
+        else:
+            runs, weight = n_runs, 1
+
+        tasks.extend(
+            [(algo, {cl[1][0]: v}, weight) for v in cl[1][1] for _ in range(runs)]
+        )
+
+    # Seeds and subsamples are drawn up front so that each fit gets the same
+    # ones whatever the number of workers
+    rng = np.random.default_rng(random_state)
+
+    if random_state is None:
+        seeds = [None] * len(tasks)
+    else:
+        seeds = rng.integers(0, np.iinfo(np.int32).max, size=len(tasks)).tolist()
+
+    if subsample:
+        rows = [
+            rng.choice(n_obs, size=sample or n_obs, replace=bootstrap)
+            for _ in range(len(tasks))
+        ]
+    else:
+        rows = [None] * len(tasks)
+
+    return [
+        (algo, par, seed, task_rows, weight)
+        for (algo, par, weight), seed, task_rows in zip(tasks, seeds, rows)
+    ]
+
+
+def fit_labels(
+    task: tuple, vectors: np.ndarray, similarities: dict = None
+) -> np.ndarray:
+    """Fits one model of the ensemble and returns its compact label vector
+
+    Args:
+        task: (algorithm, parameters, seed, rows, weight) tuple from
+            ensemble_tasks
+        vectors: vectors to cluster
+        similarities: lookup between algorithms and precomputed similarity
+            matrices for them
+
+    Returns:
+        Cluster labels recoded as consecutive integers, with -1 for
+            observations outside the subsample
+    """
+
+    algo, par, seed, rows, _ = task
+
+    if seed is not None and "random_state" in algo().get_params():
+        par = {**par, "random_state": seed}
+
+    if similarities is not None and algo in similarities:
+        par = {**par, "affinity": "precomputed"}
+        inputs = similarities[algo]
+        if rows is not None:
+            inputs = inputs[np.ix_(rows, rows)]
+    else:
+        inputs = vectors if rows is None else vectors[rows]
+
+    _, labels = np.unique(algo(**par).fit_predict(inputs), return_inverse=True)
+    labels = labels.ravel().astype(np.int32)
+
+    if rows is None:
+        return labels
+
+    all_labels = np.full(len(vectors), -1, dtype=np.int32)
+    all_labels[rows] = labels
+
+    return all_labels
+
+
+def run_ensemble(
+    vectors: pd.DataFrame,
+    clustering_algorithms: list,
+    n_runs: int = 10,
+    n_jobs: int = 1,
+    random_state: int = None,
+    sample: int = None,
+    bootstrap: bool = False,
+) -> tuple:
+    """Runs the clustering ensemble, optionally across a process pool
+
+    Args:
+        vectors: vectors to cluster
+        clustering_algorithms: a list where the first element is the clustering
+            algorithm and the second element are the parameter names and sets
+        n_runs: number of times to run a clustering algorithm
+        n_jobs: number of worker processes. -1 uses all the available cores
+        random_state: seed for the ensemble. Results are reproducible for a
+            given seed regardless of n_jobs
+        sample: size of the random subsample clustered in each run
+        bootstrap: draw the subsamples with replacement
+
+    Returns:
+        A list with the label vector of each fit and a list with the number
+            of runs each of them stands for
+    """
+
+    tasks = ensemble_tasks(
+        clustering_algorithms, n_runs, random_state, len(vectors), sample, bootstrap
+    )
+
+    vectors = vectors.to_numpy()
+    similarities = {
+        algo: similarity(vectors)
+        for algo, similarity in precomputed_affinities.items()
+        if algo in {task[0] for task in tasks}
+    }
+    fit = partial(fit_labels, vectors=vectors, similarities=similarities)
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+    n_all_fits = sum(len(cl[1][1]) for cl in clustering_algorithms) * n_runs
+    logging.info(
+        f"Running cluster ensemble: {len(tasks)} fits, {n_jobs} workers. "
+        f"Skipped {n_all_fits - len(tasks)} of {n_all_fits} fits "
+        "for deterministic algorithms"
+    )
+
+    if n_jobs == 1:
+        cluster_labels = [fit(task) for task in tasks]
+
+    else:
+        # Spawned rather than forked workers, see clustering_grid_search
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            cluster_labels = list(
+                executor.map(fit, tasks, chunksize=max(1, len(tasks) // (4 * n_jobs)))
+            )
+
+    return cluster_labels, [task[4] for task in tasks]
+
+
 def build_cluster_graph(
     vectors: pd.DataFrame,
     clustering_algorithms: list,
     n_runs: int = 10,
     sample: int = None,
+    bootstrap: bool = False,
+    sparse: bool = False,
+    n_jobs: int = 1,
+    random_state: int = None,
+    min_count: int = None,
+    top_k: int = None,
 ):
     """Builds a cluster network based on observation co-occurrences
     in a clustering output
@@ -155,86 +931,140 @@ def build_cluster_graph(
         clustering_algorithms: a list where the first element is the clustering
             algorithm and the second element are the parameter names and sets
         n_runs: number of times to run a clustering algorithm
-        sample: size of the vector to sample.
+        sample: size of the vector to sample in each run.
+        bootstrap: sample with replacement
+        sparse: build the co-association matrix as a sparse matrix
+        n_jobs: number of worker processes used to run the ensemble
+        random_state: seed for the ensemble
+        min_count: minimum number of co-occurrences for an edge
+        top_k: maximum number of strongest edges kept for each observation.
+            Use min_count or top_k with sparse=True for large geographies
+            (e.g. LSOAs) to bound memory by the number of edges
 
     Returns:
         A network where the nodes are observations and their edges number
             of co-occurrences in the clustering
-
-    #FIXUP: remove the nested loops
     """
 
-    clustering_edges = []
-
     index_to_id_lookup = {n: ind for n, ind in enumerate(vectors.index)}
 
-    logging.info("Running cluster ensemble")
-    for cl in clustering_algorithms:
+    cluster_labels, weights = run_ensemble(
+        vectors, clustering_algorithms, n_runs, n_jobs, random_state, sample, bootstrap
+    )
 
-        logging.info(cl[0])
+    logging.info("Building cluster graph")
 
-        algo = cl[0]
+    cluster_graph = coassociation_graph(
+        coassociation_matrix(
+            cluster_labels,
+            weights,
+            sparse=sparse,
+            min_count=min_count,
+            top_k=top_k,
+        )
+    )
 
-        parametres = [{cl[1][0]: v} for v in cl[1][1]]
+    return cluster_graph, index_to_id_lookup
 
-        for par in parametres:
 
-            logging.info(f"running {par}")
+def prepare_python_louvain(
+    cluster_graph: Union[nx.Graph, np.ndarray, sp.spmatrix],
+) -> nx.Graph:
+    """Prepares a cluster graph or co-association matrix for python-louvain"""
 
-            for _ in range(n_runs):
+    if isinstance(cluster_graph, nx.Graph):
+        return cluster_graph
 
-                cl_assignments = algo(**par).fit_predict(vectors)
-                index_cluster_pair = {n: c for n, c in enumerate(cl_assignments)}
+    return coassociation_graph(cluster_graph)
 
-                indices = range(0, len(cl_assignments))
 
-                pairs = combinations(indices, 2)
+def detect_python_louvain(
+    cluster_graph: nx.Graph, resolution: float, random_state: int = None
+) -> dict:
+    """Community detection with python-louvain"""
 
-                for p in pairs:
+    return community_louvain.best_partition(
+        cluster_graph, resolution=resolution, random_state=random_state
+    )
 
-                    if index_cluster_pair[p[0]] == index_cluster_pair[p[1]]:
-                        clustering_edges.append(frozenset(p))
 
-    edges_weighted = Counter(clustering_edges)
+def prepare_csr_louvain(cluster_graph) -> tuple:
+    """Prepares a cluster graph or co-association matrix for the CSR louvain"""
 
-    logging.info("Building cluster graph")
+    if isinstance(cluster_graph, tuple):
+        return cluster_graph
 
-    edge_list = [(list(fs)[0], list(fs)[1]) for fs in edges_weighted.keys()]
-    cluster_graph = nx.Graph()
-    cluster_graph.add_edges_from(edge_list)
+    return csr_graph(cluster_graph)
 
-    for ed in cluster_graph.edges():
 
-        cluster_graph[ed[0]][ed[1]]["weight"] = edges_weighted[
-            frozenset([ed[0], ed[1]])
-        ]
+def detect_csr_louvain(
+    cluster_graph: tuple, resolution: float, random_state: int = None
+) -> dict:
+    """Community detection with the CSR louvain implementation"""
 
-    return cluster_graph, index_to_id_lookup
+    adjacency, nodes = cluster_graph
+    communities = louvain_communities(adjacency, resolution, random_state)
+
+    return dict(zip(nodes.tolist(), communities.tolist()))
+
+
+# Lookup between community detection backends and the functions
+# to prepare a cluster graph and detect communities in it. csr-louvain
+# follows python-louvain's use of the resolution but visits nodes in a
+# different random order, so the backends give similar but not identical
+# partitions (see louvain.py). Grid search results record their backend
+community_backends = {
+    "python-louvain": (prepare_python_louvain, detect_python_louvain),
+    "csr-louvain": (prepare_csr_louvain, detect_csr_louvain),
+}
+
+
+def prepare_community_graph(cluster_graph, backend: str = "python-louvain"):
+    """Converts a cluster graph or co-association matrix into the input of
+    a community detection backend. Preparing the graph once lets us reuse it
+    across community resolutions.
+
+    Args:
+        cluster_graph: networkx graph or co-association matrix
+        backend: a key in community_backends
+
+    Returns:
+        A graph that extract_communities can use with the same backend
+    """
+
+    if backend not in community_backends:
+        raise ValueError(
+            f"Unknown community backend {backend}. "
+            f"Options are {list(community_backends.keys())}"
+        )
+
+    return community_backends[backend][0](cluster_graph)
 
 
 def extract_communities(
-    cluster_graph: nx.Graph, resolution: float, index_lookup: dict
-) -> list:
+    cluster_graph,
+    resolution: float,
+    index_lookup: dict,
+    backend: str = "python-louvain",
+    random_state: int = None,
+) -> dict:
     """Extracts community from the cluster graph and names them
 
     Args:
-        cluster_graph: network object
+        cluster_graph: network object, co-association matrix or the output
+            of prepare_community_graph for the same backend
         resolution: resolution for community detection
         index_lookup: lookup between integer indices and project ids
+        backend: community detection backend (see community_backends)
+        random_state: seed for community detection
 
     Returns:
         a lookup between communities and the projects that belong to them
     """
     logging.info("Extracting communities")
-    comms = community_louvain.best_partition(cluster_graph, resolution=resolution)
 
-    comm_assignments = {
-        comm: [index_lookup[k] for k, v in comms.items() if v == comm]
-        for comm in set(comms.values())
-    }
+    comms = community_backends[backend][1](
+        prepare_community_graph(cluster_graph, backend), resolution, random_state
+    )
 
-    return {
-        lad: cluster
-        for cluster, lad_list in comm_assignments.items()
-        for lad in lad_list
-    }
+    return {index_lookup[node]: comm for node, comm in comms.items()}
@@ -1,10 +1,8 @@
 import logging
-import pickle
 from functools import partial
 
 import numpy as np
 import pandas as pd
-from itertools import product
 from toolz import pipe
 from scipy.stats import zscore
 
@@ -17,7 +15,7 @@ from afs_neighbourhood_analysis.analysis.feature_selection_scratch import (
 
 from afs_neighbourhood_analysis.pipeline.lad_clustering.cluster_utils import (
     clustering_params,
-    clustering_consequential_pipe,
+    clustering_grid_search,
     parse_phf,
 )
 
@@ -75,20 +73,19 @@ if __name__ == "__main__":
     logging.info(public_health_profile.head())
 
     logging.info("Clustering grid search")
-    search_params = product(range(5, 90, 15), np.arange(0.4, 1.1, 0.1))
-
-    clustering_results = [
-        clustering_consequential_pipe(
-            public_health_profile,
-            param[0],
-            param[1],
-            early_years,
-            clustering_params,
-        )
-        for param in search_params
-    ]
 
-    with open(
-        f"{PROJECT_DIR}/inputs/data/cluster_grid_search_results.p", "wb"
-    ) as outfile:
-        pickle.dump(clustering_results, outfile)
+    # Reductions and cluster graphs are computed once per pca value and
+    # cached so that reruns with the same inputs skip the ensemble.
+    # Results are saved as they complete, and a rerun after a crash
+    # picks up the configurations that are missing
+    clustering_grid_search(
+        public_health_profile,
+        range(5, 90, 15),
+        np.arange(0.4, 1.1, 0.1),
+        early_years,
+        clustering_params,
+        cache_dir=f"{PROJECT_DIR}/inputs/data/cluster_graph_cache",
+        results_path=f"{PROJECT_DIR}/inputs/data/cluster_grid_search_results.jsonl",
+        n_workers=3,
+        random_state=0,
+    )
@@ -0,0 +1,234 @@
+"""Louvain community detection on scipy CSR matrices.
+
+This reimplements `community_louvain.best_partition` (python-louvain) on
+the co-association matrix directly instead of a networkx graph. It follows
+python-louvain's handling of the resolution: nodes move to the community
+with the best gain in modularity with a resolution-scaled null model, but
+levels (and passes over the nodes) stop when `partition_quality`, which
+scales the weight inside communities instead, stops improving. With a
+resolution below 1 this stops aggregating earlier, giving more communities
+than optimising the resolution-scaled modularity would.
+
+The two backends visit nodes in different random orders, so they don't
+return identical partitions, but they give similar partitions at every
+resolution (see benchmark.py).
+
+We represent graphs as symmetric matrices where off-diagonal entries are
+edge weights and diagonal entries are twice the weight of self-loops.
+This means that row sums are node degrees, the matrix sum is twice the total
+weight and collapsing communities into nodes is just P.T @ A @ P.
+"""
+
+import logging
+from typing import Tuple, Union
+
+import networkx as nx
+import numpy as np
+from scipy import sparse as sp
+
+# Smallest increase in partition_quality for another level or pass, as in
+# python-louvain
+MIN_INCREASE = 1e-7
+
+
+def csr_graph(
+    cluster_graph: Union[nx.Graph, np.ndarray, sp.spmatrix],
+) -> Tuple[sp.csr_matrix, np.ndarray]:
+    """Converts a cluster graph or co-association matrix into a CSR adjacency
+    matrix for louvain_communities
+
+    Args:
+        cluster_graph: networkx graph or symmetric co-association matrix
+
+    Returns:
+        The adjacency matrix and the node each of its rows refers to. Nodes
+            without edges in a co-association matrix are dropped, as they
+            would be absent from the equivalent graph
+    """
+
+    if isinstance(cluster_graph, nx.Graph):
+        nodes = np.array(list(cluster_graph.nodes))
+        adjacency = nx.to_scipy_sparse_array(
+            cluster_graph, nodelist=nodes.tolist(), weight="weight", format="csr"
+        )
+    else:
+        adjacency = sp.csr_matrix(cluster_graph)
+        nodes = np.flatnonzero(np.asarray(abs(adjacency).sum(axis=1)).ravel() > 0)
+        adjacency = adjacency[nodes][:, nodes]
+
+    adjacency = sp.csr_matrix(adjacency, dtype=np.float64)
+
+    # Self-loops count twice in the degree of a node
+    adjacency = (adjacency + sp.diags(adjacency.diagonal())).tocsr()
+
+    return adjacency, nodes
+
+
+def louvain_communities(
+    adjacency: sp.csr_matrix,
+    resolution: float = 1.0,
+    random_state: int = None,
+    max_passes: int = 100,
+) -> np.ndarray:
+    """Finds communities with the Louvain method
+
+    Args:
+        adjacency: symmetric adjacency matrix as returned by csr_graph
+        resolution: resolution for community detection. Higher values
+            give more and smaller communities
+        random_state: seed for the order in which nodes are visited
+        max_passes: maximum number of passes over the nodes in each level
+
+    Returns:
+        The community of each row of the adjacency matrix
+    """
+
+    rng = np.random.default_rng(random_state)
+
+    communities = np.arange(adjacency.shape[0])
+    quality = None
+    level = 0
+
+    while True:
+        level_communities = _one_level(adjacency, resolution, rng, max_passes)
+        n_communities = level_communities.max() + 1 if len(level_communities) else 0
+
+        # The first level is always kept
+        level_quality = partition_quality(adjacency, level_communities, resolution)
+        if quality is not None and level_quality - quality < MIN_INCREASE:
+            break
+        quality = level_quality
+
+        if n_communities == adjacency.shape[0]:
+            break
+
+        communities = level_communities[communities]
+
+        membership = _membership(level_communities)
+        adjacency = (membership.T @ adjacency @ membership).tocsr()
+        level += 1
+
+    logging.info(f"Louvain: {communities.max() + 1} communities, {level} levels")
+
+    return communities
+
+
+def partition_quality(
+    adjacency: sp.csr_matrix, communities: np.ndarray, resolution: float = 1.0
+) -> float:
+    """Modularity of a partition as python-louvain calculates it, with the
+    resolution scaling the weight inside communities. This is the same as
+    `community_louvain.modularity` for a resolution of 1
+
+    Args:
+        adjacency: symmetric adjacency matrix as returned by csr_graph
+        communities: community of each row of the adjacency matrix
+        resolution: resolution for community detection
+
+    Returns:
+        The quality of the partition
+    """
+
+    total_weight = adjacency.sum()
+
+    if total_weight == 0:
+        return 0.0
+
+    membership = _membership(np.unique(communities, return_inverse=True)[1].ravel())
+    collapsed = membership.T @ adjacency @ membership
+    internal = collapsed.diagonal()
+    degrees = np.asarray(collapsed.sum(axis=1)).ravel()
+
+    return float(
+        (resolution * internal / total_weight - (degrees / total_weight) ** 2).sum()
+    )
+
+
+def _membership(communities: np.ndarray) -> sp.csr_matrix:
+    """Matrix with a row per node and a one in the column of its community"""
+
+    return sp.csr_matrix(
+        (np.ones(len(communities)), (np.arange(len(communities)), communities)),
+        shape=(len(communities), communities.max() + 1 if len(communities) else 0),
+    )
+
+
+def _one_level(
+    adjacency: sp.csr_matrix,
+    resolution: float,
+    rng: np.random.Generator,
+    max_passes: int,
+) -> np.ndarray:
+    """Moves nodes between communities until modularity stops improving
+
+    Returns:
+        The community of each node, numbered consecutively
+    """
+
+    n_nodes = adjacency.shape[0]
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    total_weight = degrees.sum()
+
+    communities = np.arange(n_nodes)
+    community_degrees = degrees.copy()
+
+    if total_weight == 0:
+        return communities
+
+    indptr, indices, data = adjacency.indptr, adjacency.indices, adjacency.data
+    quality = partition_quality(adjacency, communities, resolution)
+
+    for _ in range(max_passes):
+        moved = False
+
+        for node in rng.permutation(n_nodes):
+            start, end = indptr[node], indptr[node + 1]
+            neighbours = indices[start:end]
+            not_self = neighbours != node
+
+            current = communities[node]
+            community_degrees[current] -= degrees[node]
+
+            neighbour_communities, position = np.unique(
+                communities[neighbours[not_self]], return_inverse=True
+            )
+            links = np.bincount(
+                position.ravel(),
+                weights=data[start:end][not_self],
+                minlength=len(neighbour_communities),
+            )
+
+            # Gain (up to a constant factor) of adding the node to
+            # each neighbouring community
+            gains = (
+                links
+                - resolution
+                * community_degrees[neighbour_communities]
+                * degrees[node]
+                / total_weight
+            )
+
+            stay = (
+                -resolution * community_degrees[current] * degrees[node] / total_weight
+            )
+            is_current = neighbour_communities == current
+            if is_current.any():
+                stay += links[is_current][0]
+
+            best = current
+            if len(gains) > 0 and gains.max() > stay + 1e-12:
+                best = neighbour_communities[gains.argmax()]
+                moved = moved or best != current
+
+            communities[node] = best
+            community_degrees[best] += degrees[node]
+
+        if not moved:
+            break
+
+        pass_quality = partition_quality(adjacency, communities, resolution)
+        if pass_quality - quality < MIN_INCREASE:
+            break
+        quality = pass_quality
+
+    return np.unique(communities, return_inverse=True)[1].ravel()
@@ -0,0 +1,312 @@
+"""Persistent on-disk cache for HTTP responses.
+
+Responses are stored gzipped under the sha256 of their content (so identical
+responses are only stored once) and indexed by a hash of the request url and
+parameters. Entries older than the cache ttl are revalidated with the server
+using their ETag / Last-Modified headers.
+
+    cache = ResponseCache(f"{PROJECT_DIR}/inputs/data/http_cache/fingertips")
+    content = cache.get("https://fingertips.phe.org.uk/api/profiles")
+    cache.stats()
+    cache.prune(max_bytes=500e6)
+
+make_session gives the pooled, retrying session we use for HTTP requests.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session(
+    max_connections: int = 8, retries: int = 3, backoff_factor: float = 0.5
+) -> requests.Session:
+    """HTTP session with a pool of keep-alive connections that retries
+    failed requests with exponential backoff
+
+    Args:
+        max_connections: size of the connection pool
+        retries: number of times we retry a request
+        backoff_factor: the nth retry waits backoff_factor * 2^(n-1) seconds
+    """
+
+    adapter = HTTPAdapter(
+        pool_connections=max_connections,
+        pool_maxsize=max_connections,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "HEAD"],
+        ),
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+class ResponseCache:
+    """Content-addressed cache of HTTP GET responses
+
+    Attributes:
+        cache_dir: directory with the cache. It contains an `entries`
+            folder with the metadata of each request and an `objects` folder
+            with the compressed responses
+        ttl: seconds before an entry needs to be revalidated with the
+            server. If None entries never go stale
+        hits: requests served from the cache (including revalidated ones)
+        misses: requests that had to download the response
+        revalidated: stale entries that the server confirmed were unchanged
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path],
+        ttl: float = None,
+        session: requests.Session = None,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.session = session or requests.Session()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+
+        (self.cache_dir / "entries").mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / "objects").mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def request_key(url: str, params: dict = None) -> str:
+        """Hash of a request url and its parameters"""
+
+        return hashlib.sha256(
+            json.dumps(
+                [url, sorted((str(k), str(v)) for k, v in (params or {}).items())]
+            ).encode()
+        ).hexdigest()
+
+    def get(
+        self,
+        url: str,
+        params: dict = None,
+        session: requests.Session = None,
+        ttl: float = None,
+    ) -> bytes:
+        """Content of a GET request, from the cache if possible
+
+        Args:
+            url: url to request
+            params: query parameters
+            session: session for the request. Defaults to the cache session
+            ttl: overrides the cache ttl for this request
+
+        Returns:
+            The body of the response
+        """
+
+        entry, content = self._fetch(url, params, session, ttl)
+
+        return self._read_object(entry["content"]) if content is None else content
+
+    def content_hash(
+        self,
+        url: str,
+        params: dict = None,
+        session: requests.Session = None,
+        ttl: float = None,
+    ) -> str:
+        """sha256 of the content of a GET request. Like get, but a response
+        served from the cache isn't read and hashed again
+
+        Args:
+            url: url to request
+            params: query parameters
+            session: session for the request. Defaults to the cache session
+            ttl: overrides the cache ttl for this request
+
+        Returns:
+            The hex digest of the body of the response
+        """
+
+        return self._fetch(url, params, session, ttl)[0]["content"]
+
+    def _fetch(
+        self, url: str, params: dict, session: requests.Session, ttl: float
+    ) -> tuple:
+        """Entry for a request, revalidating or downloading it if needed
+
+        Returns:
+            The entry and the body of the response if we downloaded it
+            (None if the response is in the cache)
+        """
+
+        session = session or self.session
+        ttl = self.ttl if ttl is None else ttl
+
+        key = self.request_key(url, params)
+        entry = self._read_entry(key)
+
+        if entry is not None and (ttl is None or time.time() - entry["stored"] < ttl):
+            self._count("hits")
+            return entry, None
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = session.get(url, params=params, headers=headers)
+
+        if entry is not None and response.status_code == 304:
+            self._count("hits")
+            self._count("revalidated")
+            entry = {**entry, "stored": time.time()}
+            self._write_entry(key, entry)
+            return entry, None
+
+        response.raise_for_status()
+        self._count("misses")
+
+        entry = {
+            "url": url,
+            "params": params,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "stored": time.time(),
+            "content": self._write_object(response.content),
+            "size": len(response.content),
+        }
+        self._write_entry(key, entry)
+
+        return entry, response.content
+
+    def stats(self) -> dict:
+        """Hit and miss counters and the size of the cache"""
+
+        objects = list((self.cache_dir / "objects").glob("*/*.gz"))
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "entries": len(list((self.cache_dir / "entries").glob("*.json"))),
+            "bytes": sum(path.stat().st_size for path in objects),
+        }
+
+    def prune(self, max_age: float = None, max_bytes: float = None) -> int:
+        """Removes old entries and then the least recently stored ones until
+        the cache is under a size limit
+
+        Args:
+            max_age: remove entries stored more than max_age seconds ago
+            max_bytes: maximum size of the compressed responses
+
+        Returns:
+            Number of entries removed
+        """
+
+        entries = sorted(
+            (
+                (path, json.loads(path.read_text()))
+                for path in (self.cache_dir / "entries").glob("*.json")
+            ),
+            key=lambda entry: entry[1]["stored"],
+        )
+
+        removed = []
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            removed = [e for e in entries if e[1]["stored"] < cutoff]
+            entries = [e for e in entries if e[1]["stored"] >= cutoff]
+
+        object_sizes = {
+            path.stem: path.stat().st_size
+            for path in (self.cache_dir / "objects").glob("*/*.gz")
+        }
+
+        if max_bytes is not None:
+            kept_objects = {e[1]["content"] for e in entries}
+            total = sum(object_sizes.get(obj, 0) for obj in kept_objects)
+
+            while total > max_bytes and len(entries) > 0:
+                entry = entries.pop(0)
+                removed.append(entry)
+                # The object can be shared with another entry
+                if entry[1]["content"] not in {e[1]["content"] for e in entries}:
+                    total -= object_sizes.get(entry[1]["content"], 0)
+
+        for path, _ in removed:
+            path.unlink(missing_ok=True)
+
+        # Remove responses that no entry refers to anymore
+        kept_objects = {e[1]["content"] for e in entries}
+        for obj in set(object_sizes) - kept_objects:
+            self._object_path(obj).unlink(missing_ok=True)
+
+        logging.info(f"Removed {len(removed)} entries from {self.cache_dir}")
+
+        return len(removed)
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _object_path(self, content_hash: str) -> Path:
+        return self.cache_dir / "objects" / content_hash[:2] / f"{content_hash}.gz"
+
+    def _read_entry(self, key: str) -> dict:
+        path = self.cache_dir / "entries" / f"{key}.json"
+        try:
+            entry = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        # An entry whose response was pruned is a miss
+        return entry if self._object_path(entry["content"]).exists() else None
+
+    def _write_entry(self, key: str, entry: dict):
+        self._atomic_write(
+            self.cache_dir / "entries" / f"{key}.json", json.dumps(entry).encode()
+        )
+
+    def _read_object(self, content_hash: str) -> bytes:
+        with gzip.open(self._object_path(content_hash), "rb") as infile:
+            return infile.read()
+
+    def _write_object(self, content: bytes) -> str:
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._object_path(content_hash)
+
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            self._atomic_write(path, gzip.compress(content))
+
+        return content_hash
+
+    @staticmethod
+    def _atomic_write(path: Path, content: bytes):
+        """Writes to a temporary file and renames it so that readers never
+        see a partial file
+        """
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(content)
+        os.replace(tmp_path, path)
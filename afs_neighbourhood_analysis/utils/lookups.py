@@ -0,0 +1,147 @@
+"""Lookup tables built once per data version.
+
+Lookups (dicts or dataframes) are persisted in a directory together with the
+version of the data they were built from, and memoised in the process.
+A lookup is rebuilt when the version we ask for is different from the stored
+one. Finding out the version can itself be slow, so version functions can be
+memoised for a short time with memoise_for.
+
+    store = LookupStore(f"{PROJECT_DIR}/inputs/data/lookups")
+    names = store.get("area_names", run.pathspec, build_area_names)
+"""
+
+import json
+import logging
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Union
+
+import pandas as pd
+
+Lookup = Union[dict, pd.DataFrame]
+
+# Memo entry of lookups that haven't been memoised yet
+_NOT_MEMOISED = (object(), None)
+
+
+class LookupStore:
+    """Persistent, memoised lookups keyed by name and data version
+
+    Attributes:
+        lookup_dir: directory where lookups are saved. Dicts are saved as
+            json and dataframes as parquet, with a `.meta.json` file
+            recording the data version
+    """
+
+    def __init__(self, lookup_dir: Union[str, Path]):
+        self.lookup_dir = Path(lookup_dir)
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, version: str, build: Callable[[], Lookup]) -> Lookup:
+        """Returns a lookup for a data version, building it if needed
+
+        Args:
+            name: name of the lookup
+            version: identifier of the data the lookup is built from
+            build: function that builds the lookup
+
+        Returns:
+            The lookup
+        """
+
+        if version is None:
+            raise ValueError(f"Lookup {name} needs a data version")
+
+        with self._lock:
+            memo_version, lookup = self._memo.get(name, _NOT_MEMOISED)
+            if memo_version == version:
+                return lookup
+
+            lookup = self._load(name, version)
+            if lookup is None:
+                logging.info(f"Building lookup {name} for version {version}")
+                lookup = build()
+                self._save(name, version, lookup)
+
+            self._memo[name] = (version, lookup)
+
+            return lookup
+
+    def stored_version(self, name: str) -> str:
+        """Version of the data a stored lookup was built from (None if the
+        lookup hasn't been stored)
+        """
+
+        try:
+            return json.loads(self._meta_path(name).read_text())["version"]
+        except FileNotFoundError:
+            return None
+
+    def clear(self):
+        """Empties the in-process memo"""
+
+        with self._lock:
+            self._memo = {}
+
+    def _meta_path(self, name: str) -> Path:
+        return self.lookup_dir / f"{name}.meta.json"
+
+    def _load(self, name: str, version: str) -> Lookup:
+        try:
+            meta = json.loads(self._meta_path(name).read_text())
+        except FileNotFoundError:
+            return None
+
+        if meta["version"] != version:
+            return None
+
+        if meta["format"] == "parquet":
+            return pd.read_parquet(self.lookup_dir / f"{name}.parquet")
+
+        # Dicts are stored as lists of items so that non-string keys survive
+        with open(self.lookup_dir / f"{name}.json") as infile:
+            return {key: value for key, value in json.load(infile)}
+
+    def _save(self, name: str, version: str, lookup: Lookup):
+        self.lookup_dir.mkdir(parents=True, exist_ok=True)
+
+        if isinstance(lookup, pd.DataFrame):
+            lookup_format = "parquet"
+            lookup.to_parquet(self.lookup_dir / f"{name}.parquet", index=False)
+        else:
+            lookup_format = "json"
+            with open(self.lookup_dir / f"{name}.json", "w") as outfile:
+                json.dump(list(lookup.items()), outfile)
+
+        # The metadata is written last so that an interrupted save is
+        # rebuilt next time
+        self._meta_path(name).write_text(
+            json.dumps({"version": version, "format": lookup_format})
+        )
+
+
+def memoise_for(seconds: float) -> Callable:
+    """Decorator that memoises the results of a function in the process for
+    a number of seconds. The memo is emptied with `function.cache_clear()`
+    """
+
+    def decorator(function: Callable) -> Callable:
+        memo = {}
+
+        @wraps(function)
+        def memoised(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            stored, value = memo.get(key, (None, None))
+            if stored is None or time.monotonic() - stored > seconds:
+                value = function(*args, **kwargs)
+                memo[key] = (time.monotonic(), value)
+            return value
+
+        memoised.cache_clear = memo.clear
+
+        return memoised
+
+    return decorator
@@ -0,0 +1,170 @@
+"""Read-only file objects over HTTP range requests.
+
+zipfile only needs to seek and read, so wrapping a remote zip with
+HTTPRangeFile lets us read its central directory and extract individual
+members without downloading the whole archive:
+
+    remote = open_http_range(zip_url)
+    if remote is not None:
+        ZipFile(remote).extract("APS_GLD_ELG_EXP_2013_2019.csv")
+"""
+
+import io
+import logging
+import re
+
+import requests
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """Seekable file whose reads are served with HTTP Range requests
+
+    Reads are rounded up to `block_size` bytes and buffered, so the many
+    small reads zipfile makes for headers don't turn into many requests.
+    Sequential reads (decompressing a member) double the size of each
+    request up to `max_block_size`.
+
+    Attributes:
+        url: url of the file
+        size: size of the file in bytes
+        etag: if given, ranges are requested with If-Range so that a change
+            of the file while we read it raises an error
+        bytes_fetched: bytes downloaded so far
+        requests_made: number of range requests made so far
+    """
+
+    def __init__(
+        self,
+        url: str,
+        size: int,
+        session: requests.Session = None,
+        block_size: int = 1 << 16,
+        max_block_size: int = 1 << 23,
+        etag: str = None,
+    ):
+        super().__init__()
+        self.url = url
+        self.size = size
+        self.session = session or requests.Session()
+        self.block_size = block_size
+        self.max_block_size = max_block_size
+        # If-Range needs a strong validator
+        self.etag = etag if etag and not etag.startswith("W/") else None
+        self.bytes_fetched = 0
+        self.requests_made = 0
+
+        self._position = 0
+        self._buffer = b""
+        self._buffer_start = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+
+        if self._position < 0:
+            raise ValueError("Negative seek position")
+
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), self.size - self._position)
+        view = memoryview(buffer)
+        read = 0
+
+        while read < n:
+            offset = self._position - self._buffer_start
+            if 0 <= offset < len(self._buffer):
+                chunk = self._buffer[offset : offset + n - read]
+                view[read : read + len(chunk)] = chunk
+                read += len(chunk)
+                self._position += len(chunk)
+                continue
+
+            if self._position == self._buffer_start + len(self._buffer):
+                # Sequential read
+                length = max(n - read, min(2 * len(self._buffer), self.max_block_size))
+                self._fetch(self._position, length)
+            else:
+                # Near the end of the file we also fetch the bytes before the
+                # position, which is where the zip central directory is
+                length = max(n - read, self.block_size)
+                self._fetch(max(0, min(self._position, self.size - length)), length)
+
+        return max(n, 0)
+
+    def _fetch(self, start: int, length: int):
+        end = min(start + length, self.size) - 1
+
+        headers = {"Range": f"bytes={start}-{end}"}
+        if self.etag is not None:
+            headers["If-Range"] = self.etag
+
+        response = self.session.get(self.url, headers=headers)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"{self.url} ignored a range request")
+
+        self._buffer = response.content
+        self._buffer_start = start
+        self.bytes_fetched += len(response.content)
+        self.requests_made += 1
+
+
+def range_size(response: requests.Response) -> int:
+    """Size of a file from the response to a range request starting at 0,
+    or None if the server ignored the range
+    """
+
+    content_range = re.match(
+        r"bytes 0-\d+/(\d+)", response.headers.get("Content-Range", "")
+    )
+
+    if response.status_code != 206 or content_range is None:
+        return None
+
+    return int(content_range.group(1))
+
+
+def open_http_range(
+    url: str, session: requests.Session = None, block_size: int = 1 << 16
+) -> HTTPRangeFile:
+    """Opens a remote file for range requests
+
+    Args:
+        url: url of the file
+        session: session for the requests
+        block_size: minimum number of bytes fetched with each request
+
+    Returns:
+        A HTTPRangeFile, or None if the server doesn't support range requests
+    """
+
+    session = session or requests.Session()
+
+    # A one byte range tells us if ranges are supported and the size of the
+    # file (in the Content-Range header)
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True) as response:
+        response.raise_for_status()
+        size = range_size(response)
+        etag = response.headers.get("ETag")
+
+    if size is None:
+        logging.info(f"{url} doesn't support range requests")
+        return None
+
+    return HTTPRangeFile(url, size, session, block_size, etag=etag)